@@ -5,10 +5,9 @@ See also https://en.wikipedia.org/wiki/Monte_Carlo_tree_search
 https://gist.github.com/qpwo/c538c6f73727e254fdc7fab81024f6e1
 """
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque
 import math
 from random import random, choice
-import numpy
 
 
 class Node(ABC):
@@ -23,6 +22,10 @@ class Node(ABC):
         "All possible successors of this board state"
         return list()
 
+    def find_ordered_children(self, player):
+        "Successors of this board state, most promising first (for progressive widening)"
+        return iter(self.find_children(player) or ())
+
     @abstractmethod
     def find_random_child(self):
         "Random successor of this board state (for more efficient simulation)"
@@ -33,6 +36,25 @@ class Node(ABC):
         "Random successor of this board state (for more efficient simulation)"
         return None
 
+    def move_id(self):
+        "Id of the move that led to this board state (for RAVE), None if unknown"
+        return None
+
+    def child_frame(self, child):
+        "Frame of the move id of `child` relative to this node, for games whose nodes merge symmetric boards"
+        return 0
+
+    def amaf_move(self, move, frame=0):
+        "Key of `move` (given in `frame`) in the AMAF statistics of this node"
+        return move
+
+    def align_path(self, path, moves=None, boards=None):
+        "(moves, boards, frames) of a rollout from this node, all in one frame (see game.State)"
+        sequence = [node.move_id() for node in path[1:]] + list(moves or ())
+        if boards is not None:
+            boards = [node.board for node in path] + boards
+        return sequence, boards, [0] * len(path)
+
     @abstractmethod
     def is_terminal(self):
         "Returns True if the node has no children"
@@ -59,23 +81,38 @@ class Node(ABC):
 class MCTS:
     "Monte Carlo tree searcher. First rollout the tree then choose a move."
 
-    def __init__(self, player="O", checkpoint=None, exploration_weight=numpy.sqrt(2), epsilon = 0.4, opponent_level=0.1 ,q = defaultdict(float), n = defaultdict(int)):
+    def __init__(self, player="O", checkpoint=None, exploration_weight=math.sqrt(2), epsilon = 0.4, opponent_level=0.1 ,q = defaultdict(float), n = defaultdict(int),
+                 widening=None, widening_alpha=0.5, playout=None, solver=None, rave=False, rave_equivalence=300, recorder=None):
         self.Q = q  # total reward of each node
         self.N = n  # total visit count for each node
         self.children = dict()  # children of each (visited?) node
+        self.unexplored = dict()  # children of each node that were never expanded
+        self.pending = dict()  # children of each node not unlocked yet (progressive widening)
+        self.widening = widening  # None expands all children at once, else a node visited N times has ceil(widening * N**widening_alpha) children
+        self.widening_alpha = widening_alpha
+        self.playout = playout  # playout policy (see playout.py), None plays the epsilon-greedy simulation below
+        self.solver = solver  # exact endgame solver (see solver.py), or None
+        self.solved = dict()  # proven reward of each (node, player to move)
+        self.rave = rave  # All-Moves-As-First statistics, blended in the UCT value
+        self.rave_equivalence = rave_equivalence  # visits at which AMAF and real values weigh the same (roughly)
+        self.AQ = defaultdict(float)  # AMAF total reward of each (node, move id)
+        self.AN = defaultdict(int)  # AMAF visit count of each (node, move id)
+        self.recorder = recorder  # writes every rollout to disk (see trajectories.py), or None
         self.exploration_weight = exploration_weight
         self.epsilon = epsilon
         self.player = player
         self.checkpoint = checkpoint
         self.opponent_level = opponent_level
 
-    def change_player(self):
-        if self.player == "X":
+    def change_player(self, player=None):
+        if player is None:
+            player = self.player
+        if player == "X":
             return "O"
-        elif self.player=="O":
+        elif player=="O":
             return "X"
 
-    def choose(self, node : Node, opponent="X"):
+    def choose(self, node : Node, opponent="X", verbose=True):
         "Choose the best successor of node. (Choose a move in the game)"
         if node.is_terminal():
             raise RuntimeError(f"choose called on terminal node {node}")
@@ -85,6 +122,14 @@ class MCTS:
         else:
             myself="O"
 
+        ## a forced win is there, just play it
+        if self.solver is not None:
+            reward, child = self.solver.solve(node, myself)
+            if reward == self.solver.reward_for(myself):
+                if verbose:
+                    print(f"chose node {child.board}, proven win")
+                return child
+
         ## i didn't see this node in training, lets return a random move
         if node not in self.Q:
             return node.find_random_child(myself)
@@ -99,31 +144,110 @@ class MCTS:
 
         if opponent!=self.player:
             ret =  max(node.find_children(myself), key=score)
-            print(f"chose node {ret.board} with score {score(ret)}")
+            if verbose:
+                print(f"chose node {ret.board} with score {score(ret)}")
             return ret
         else:
             ret = min(node.find_children(myself), key=lambda n: score(n, reverse=True))      
-            print(f"chose node {ret.board} with score {score(ret, reverse=True)}")
+            if verbose:
+                print(f"chose node {ret.board} with score {score(ret, reverse=True)}")
             return ret
 
 
-    def do_rollout(self,node):
-        "Make the tree one layer better. (Train for one iteration.)"
-        path = self._select(node)
+    def choose_many(self, boards, opponent="X"):
+        '''
+        `choose` for a batch of 64-bit boards, without printing. Boards equal up to symmetry are
+        evaluated once and the statistics of all the children are looked up together.
+        Returns the chosen child (a node, in the frame of each board) or None for terminal boards
+        '''
+        from game import State  ### imported here, the game module itself imports MCTS
+        myself = "X" if opponent == "O" else "O"
+        reverse = opponent == self.player
+
+        roots = dict()  # canonical key -> node of the first board of the class
+        for board in boards:
+            node = State(int(board))
+            roots.setdefault(node.hash_key, node)
+        roots = {key: node for key, node in roots.items() if not node.is_terminal()}
+        root_list = list(roots.values())
+        root_visits = self._get_many(self.N, root_list)
+
+        children = dict()
+        batch = []
+        for node, visits in zip(root_list, root_visits):
+            if visits:
+                children[node.hash_key] = node.find_children(myself)
+                batch.extend(children[node.hash_key])
+        q_values = self._get_many(self.Q, batch)
+        n_values = self._get_many(self.N, batch)
+
+        best = dict()
+        i = 0
+        for node in root_list:
+            if node.hash_key not in children:
+                best[node.hash_key] = node.find_random_child(myself)  ## never seen, random move
+                continue
+            kids = children[node.hash_key]
+            scores = [(q / n if n else float("-inf")) for q, n in zip(q_values[i:i + len(kids)], n_values[i:i + len(kids)])]
+            if reverse:
+                scores = [(-s if s != float("-inf") else s) for s in scores]
+            best[node.hash_key] = kids[max(range(len(kids)), key=scores.__getitem__)]
+            i += len(kids)
+
+        chosen = []
+        for board in boards:
+            node = State(int(board))
+            if node.hash_key not in best:
+                chosen.append(None)
+                continue
+            child = best[node.hash_key]
+            if roots[node.hash_key].board != node.board:
+                ### same position in another frame: play the corresponding move on this board
+                child = next(State(c, row=r, col=col, direction=d, images=images, parent=node.board)
+                             for c, r, col, d, images in node.child_moves(myself) if min(images) == child.hash_key)
+            chosen.append(child)
+        return chosen
+
+    @staticmethod
+    def _get_many(table, nodes):
+        "Values of many nodes, in one go for the tables that support it (see tables.LayeredTable)"
+        if hasattr(table, "get_many"):
+            return table.get_many(nodes)
+        return [table.get(node, 0) for node in nodes]
+
+    def do_rollout(self,node, player=None):
+        "Make the tree one layer better. (Train for one iteration.) `player` is to move at `node`, self.player by default"
+        root = self.player if player is None else player
+        path = self._select(node, root)
         leaf = path[-1]
 
         if len(path)%2==0:
-            turn = self.change_player()
+            turn = self.change_player(root)
         else:
-            turn = self.player
+            turn = root
 
-        self._expand(leaf, turn)  ### adds children to leaf
-        reward = self._simulate(leaf, turn)
+        moves = [] if self.rave or self.recorder is not None else None
+        boards = [] if self.recorder is not None else None
+        if (leaf, turn) in self.solved:
+            reward = self.solved[(leaf, turn)]  ### never roll out a proven position again
+        else:
+            self._expand(leaf, turn)  ### adds children to leaf
+            reward = self._simulate(leaf, turn, moves, boards)
         self._backpropagate(path, reward)
-
-
-    def _select(self, node : Node):
-        "Find an unexplored descendent of `node`"
+        if moves is not None:
+            ### the nodes merge symmetric boards: bring the whole rollout into the frame of the root
+            sequence, boards, frames = node.align_path(path, moves, boards)
+            if self.rave:
+                self._update_amaf(path, sequence, frames, reward)
+            if self.recorder is not None:
+                self.recorder.record(root, boards, sequence, reward)
+        if self.solver is not None:
+            self._propagate_solved(path, root)
+
+
+    def _select(self, node : Node, root=None):
+        "Find an unexplored descendent of `node`, `root` being the player to move at `node`"
+        root = self.player if root is None else root
         rank = 0
         path = []
         while True:
@@ -131,12 +255,18 @@ class MCTS:
             if node not in self.children or not self.children[node]:
                 # node is either unexplored or terminal
                 return path
+            if self.solved and (node, root if len(path) % 2 else self.change_player(root)) in self.solved:
+                # node is proven, no need to go deeper
+                return path
             
             ### node is explored and not terminal, i.e. it has children
-            unexplored = self.children[node] - self.children.keys()
+            self._widen(node)
+            unexplored = self.unexplored[node]
+            while unexplored and unexplored[0] in self.children:
+                unexplored.popleft()  # expanded meanwhile through another path
             ### pop one, append to path and return 
             if unexplored:
-                n = unexplored.pop()
+                n = unexplored.popleft()
                 path.append(n)
                 return path
             
@@ -154,10 +284,41 @@ class MCTS:
         "Update the `children` dict with the children of `node`"
         if node in self.children:
             return  # already expanded
-        self.children[node] = node.find_children(player)
-
-    def _simulate(self, node : Node, last_move):
-        "Returns the reward for a random simulation (to completion) of `node`"
+        if self.widening is None:
+            self.children[node] = node.find_children(player)
+            self.unexplored[node] = deque(self.children[node] or ())
+        elif node.is_terminal():
+            self.children[node] = None  # the game is over, nothing to unlock
+            self.unexplored[node] = deque()
+        else:
+            self.children[node] = []
+            self.unexplored[node] = deque()
+            self.pending[node] = node.find_ordered_children(player)
+            self._widen(node)
+
+    def _widen(self, node):
+        "Unlock the next children of `node` (best first) as its visit count grows"
+        pending = self.pending.get(node)
+        if pending is None:
+            return  # all children already unlocked
+        allowed = math.ceil(self.widening * max(self.N[node], 1) ** self.widening_alpha)
+        while len(self.children[node]) < allowed:
+            child = next(pending, None)
+            if child is None:
+                del self.pending[node]
+                return
+            self.children[node].append(child)
+            self.unexplored[node].append(child)
+
+    def _simulate(self, node : Node, last_move, moves=None, boards=None):
+        "Returns the reward for a random simulation (to completion) of `node`. Appends the ids of the moves played to `moves`, the boards to `boards`"
+        if self.solver is not None and not node.is_terminal():
+            reward, _ = self.solver.solve(node, last_move)
+            if reward is not None:
+                self.solved[(node, last_move)] = reward
+                return reward
+        if self.playout is not None:
+            return self.playout.simulate(node, last_move, moves, boards)
         turn = last_move
         while True:
             if node.is_terminal():
@@ -172,6 +333,10 @@ class MCTS:
                     node = node.find_the_child(self.Q, player= turn, reverse=True)
                 else:
                     node = node.find_the_child(self.Q, player= turn)
+            if moves is not None:
+                moves.append(node.move_id())
+            if boards is not None:
+                boards.append(node.board)
            
             if turn == "O":
                 turn = "X"
@@ -185,6 +350,38 @@ class MCTS:
                 self.N[node] += 1
                 self.Q[node] += reward          
 
+    def _update_amaf(self, path, sequence, frames, reward):
+        "Credit the reward to every move a player made after each node of the path, as if played first. `sequence` is in the frame of the root, `frames` maps each node into it"
+        for i, node in enumerate(path):
+            seen = set()
+            for move in sequence[i::2]:  # moves of the player to move at node
+                move = node.amaf_move(move, frames[i])
+                if move is None or move in seen:
+                    continue
+                seen.add(move)
+                self.AN[(node, move)] += 1
+                self.AQ[(node, move)] += reward
+
+    def _propagate_solved(self, path, root):
+        "MCTS-Solver: a node is proven if a child wins for the player to move, or if all of its children are proven"
+        for i in range(len(path) - 2, -1, -1):
+            node = path[i]
+            turn = root if i % 2 == 0 else self.change_player(root)
+            other = self.change_player(turn)
+            if (node, turn) in self.solved:
+                continue
+            children = self.children.get(node)
+            if not children:
+                return
+            win = self.solver.reward_for(turn)
+            values = [self.solved.get((child, other)) for child in children]
+            if win in values:
+                self.solved[(node, turn)] = win
+            elif None not in values and node not in self.pending:
+                self.solved[(node, turn)] = min(values, key=lambda v: abs(v - win))  # best for the player to move
+            else:
+                return
+
     def _uct_select(self, node, rank):
         "Select a child of node, balancing exploration & exploitation"
 
@@ -195,10 +392,17 @@ class MCTS:
 
         def uct(n):
             "Upper confidence bound for trees"
-            return self.Q[n] / self.N[n] + self.exploration_weight * math.sqrt(
+            value = self.Q[n] / self.N[n]
+            if self.rave:
+                key = (node, node.amaf_move(n.move_id(), node.child_frame(n)))
+                amaf_n = self.AN.get(key, 0)
+                if amaf_n:
+                    beta = math.sqrt(self.rave_equivalence / (3 * self.N[n] + self.rave_equivalence))
+                    value = (1 - beta) * value + beta * self.AQ[key] / amaf_n
+            return value + self.exploration_weight * math.sqrt(
                 log_N_vertex / self.N[n]
             )
         sorted_uct = sorted(self.children[node], key=uct, reverse=True)
-        return sorted_uct[rank]
+        return sorted_uct[rank % len(sorted_uct)]  # a progressively widened node may have few children
 
 
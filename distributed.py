@@ -0,0 +1,274 @@
+"""
+Distributed offline training: one coordinator, any number of workers, over TCP.
+
+Each worker runs rollouts from the empty board on its own tree, whose Q/N tables are
+`LayeredTable`s over the last snapshot received from the coordinator. Every `batch`
+rollouts it ships the compact changes of its overlay, as arrays of (canonical key, ΔQ, ΔN),
+and the coordinator adds them into the master table. Every `snapshot_every` batches the
+coordinator sends the shallow part of the master table (the boards with at most
+`snapshot_pieces` pieces, i.e. the first plies of the game) back to all the workers,
+which restart their trees on it. At the end the master table is saved as a `BaseTable`.
+
+On a single box (coordinator and workers as local processes on loopback, with a random key):
+
+    python distributed.py local --workers 4 --rollouts 5000 --out models/distributed
+
+Across hosts, start the coordinator on an address the workers can reach, then the workers
+pointing at it. The connections are authenticated with a shared secret, which has no default:
+pass it with --authkey or in the QUIXO_AUTHKEY environment variable, on every host.
+The messages are pickles, so only expose the coordinator on a trusted network.
+
+    export QUIXO_AUTHKEY=<secret>
+    python distributed.py coordinator --host <its address> --port 6100 --workers 8 --out models/distributed
+    python distributed.py worker --host <coordinator> --port 6100 --rollouts 20000
+"""
+import argparse
+from multiprocessing import AuthenticationError, Process
+from multiprocessing.connection import Client, Listener, wait
+import os
+import queue
+import threading
+import time
+import numpy
+from game import State
+from MCTS import MCTS
+from playout import HeuristicPlayout, RandomPlayout
+from tables import BaseTable
+
+
+AUTHKEY_ENV = "QUIXO_AUTHKEY"
+PLAYOUTS = {"default": None, "random": RandomPlayout, "heuristic": HeuristicPlayout}
+
+
+def authkey_from(authkey=None):
+    "The shared secret of the connections: `authkey`, else the QUIXO_AUTHKEY environment variable"
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(f"no authkey: pass --authkey or set {AUTHKEY_ENV}")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def piece_count(key):
+    "Number of pieces on a board (the same for all its symmetric images)"
+    return bin(key).count("1")
+
+
+class Coordinator:
+    '''
+    Master Q/N table of a distributed training.
+    workers: number of workers to wait for, the training ends when all of them are done
+    authkey: shared secret (bytes) the workers must know to connect
+    snapshot_every: batches merged between two snapshots sent to the workers
+    snapshot_pieces: boards with at most this many pieces are in the snapshots
+    base: BaseTable to start from (e.g. a previous training), None for an empty table
+    '''
+
+    def __init__(self, address, workers, authkey, snapshot_every=20, snapshot_pieces=6, base=None):
+        self.listener = Listener(address, authkey=authkey)
+        self.workers = workers
+        self.snapshot_every = snapshot_every
+        self.snapshot_pieces = snapshot_pieces
+        self.table = dict()  # canonical key -> [Q, N]
+        self.shallow = set()  # keys of the boards in the snapshots
+        if base is not None:
+            self.merge(base.keys, base.q, base.n)
+        self.new_connections = queue.Queue()
+        self.batches = 0
+        self.rollouts = 0
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def _accept(self):
+        accepted = 0
+        while accepted < self.workers:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                continue  # wrong key: dropped, the training still waits for its workers
+            self.new_connections.put(conn)
+            accepted += 1
+
+    def merge(self, keys, q, n):
+        "Adds a batch of (key, ΔQ, ΔN) updates to the master table"
+        table = self.table
+        for key, dq, dn in zip(keys.tolist(), q.tolist(), n.tolist()):
+            entry = table.get(key)
+            if entry is None:
+                table[key] = [dq, dn]
+                if piece_count(key) <= self.snapshot_pieces:
+                    self.shallow.add(key)
+            else:
+                entry[0] += dq
+                entry[1] += dn
+
+    def snapshot(self):
+        "The shallow part of the master table, as sorted (keys, Q, N) arrays"
+        keys = sorted(self.shallow)
+        return (numpy.array(keys, dtype=numpy.int64),
+                numpy.array([self.table[k][0] for k in keys], dtype=numpy.float64),
+                numpy.array([self.table[k][1] for k in keys], dtype=numpy.int64))
+
+    def _broadcast(self, connections):
+        message = ("snapshot",) + self.snapshot()
+        for conn in connections:
+            try:
+                conn.send(message)
+            except OSError:
+                pass  # the worker is gone, its connection is dropped at its next message
+
+    def run(self):
+        "Serves the workers until all of them are done, returns the master table as a BaseTable"
+        threading.Thread(target=self._accept, daemon=True).start()
+        print(f"Coordinator listening on {self.address}, waiting for {self.workers} workers")
+        connections = []
+        done = 0
+        start = time.perf_counter()
+        while done < self.workers:
+            while not self.new_connections.empty():
+                conn = self.new_connections.get()
+                conn.send(("snapshot",) + self.snapshot())
+                connections.append(conn)
+            for conn in wait(connections, timeout=0.1):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    message = ("done", 0)
+                if message[0] == "delta":
+                    self.merge(*message[1:])
+                    self.batches += 1
+                    if self.batches % self.snapshot_every == 0:
+                        self._broadcast(connections)
+                elif message[0] == "done":
+                    self.rollouts += message[1]
+                    connections.remove(conn)
+                    conn.close()
+                    done += 1
+        self.listener.close()
+        elapsed = time.perf_counter() - start
+        print(f"Training done: {self.rollouts} rollouts from {self.workers} workers in {elapsed:.1f}s "
+              f"({self.rollouts / elapsed:.1f} rollouts/s), {self.batches} batches, {len(self.table)} positions")
+        return self.table_model()
+
+    def table_model(self):
+        keys = sorted(self.table)
+        return BaseTable(numpy.array(keys, dtype=numpy.int64),
+                         numpy.array([self.table[k][0] for k in keys], dtype=numpy.float64),
+                         numpy.array([self.table[k][1] for k in keys], dtype=numpy.int64))
+
+
+class Worker:
+    '''
+    Runs `rollouts` rollouts from the empty board and ships their statistics to the coordinator
+    every `batch` rollouts, connecting with the coordinator's `authkey`.
+    The remaining keyword arguments are passed to MCTS.
+    '''
+
+    def __init__(self, address, rollouts, authkey, batch=100, **mcts_args):
+        self.address = address
+        self.authkey = authkey
+        self.rollouts = rollouts
+        self.batch = batch
+        self.mcts_args = mcts_args
+        self.tree = None
+        self.sent = dict()  # key -> (Q, N) already accounted for by the coordinator
+
+    def install(self, keys, q, n):
+        "Restarts the tree on a snapshot of the master table"
+        q_table, n_table = BaseTable(keys, q, n).layered()
+        self.tree = MCTS(q=q_table, n=n_table, **self.mcts_args)
+        self.sent = dict()
+
+    def deltas(self):
+        "(keys, ΔQ, ΔN) arrays of the changes made since the snapshot or the last batch"
+        q_table, n_table = self.tree.Q, self.tree.N
+        keys = [key for key in n_table.overlay]
+        known = [key for key in keys if key not in self.sent]
+        for key, i in zip(known, n_table.base.find_many(known)):
+            self.sent[key] = (0.0, 0) if i < 0 else (q_table.values[i].item(), n_table.values[i].item())
+        batch = [], [], []
+        for key in keys:
+            q, n = q_table.overlay.get(key, 0.0), n_table.overlay[key]
+            sent_q, sent_n = self.sent[key]
+            if n != sent_n:
+                batch[0].append(key)
+                batch[1].append(q - sent_q)
+                batch[2].append(n - sent_n)
+                self.sent[key] = (q, n)
+        return (numpy.array(batch[0], dtype=numpy.int64), numpy.array(batch[1], dtype=numpy.float64),
+                numpy.array(batch[2], dtype=numpy.int64))
+
+    def run(self):
+        conn = Client(self.address, authkey=self.authkey)
+        message = conn.recv()
+        self.install(*message[1:])
+        done = 0
+        while done < self.rollouts:
+            for _ in range(min(self.batch, self.rollouts - done)):
+                self.tree.do_rollout(State(0))
+                done += 1
+            conn.send(("delta",) + self.deltas())
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == "snapshot":
+                    self.install(*message[1:])
+        conn.send(("done", done))
+        conn.close()
+        return done
+
+
+def _run_worker(address, authkey, rollouts, batch, playout):
+    policy = PLAYOUTS[playout]
+    Worker(address, rollouts, authkey, batch, playout=policy() if policy else None).run()
+
+
+def train_local(workers=4, rollouts=1000, batch=100, snapshot_every=20, snapshot_pieces=6,
+                playout="default", base=None, port=0):
+    '''Coordinator in this process and `workers` worker processes, on loopback.
+        Returns the trained model as a BaseTable'''
+    authkey = os.urandom(32)  # only this process and its children know it
+    coordinator = Coordinator(("127.0.0.1", port), workers, authkey, snapshot_every, snapshot_pieces, base)
+    processes = [Process(target=_run_worker, args=(coordinator.address, authkey, rollouts, batch, playout), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    model = coordinator.run()
+    for process in processes:
+        process.join()
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed offline training")
+    parser.add_argument("mode", choices=["local", "coordinator", "worker"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6100)
+    parser.add_argument("--authkey", default=None, help=f"shared secret (coordinator/worker), default ${AUTHKEY_ENV}")
+    parser.add_argument("--workers", type=int, default=4, help="workers to start (local) or wait for (coordinator)")
+    parser.add_argument("--rollouts", type=int, default=1000, help="rollouts of each worker")
+    parser.add_argument("--batch", type=int, default=100, help="rollouts between two updates sent by a worker")
+    parser.add_argument("--snapshot-every", type=int, default=20, help="batches between two snapshots")
+    parser.add_argument("--snapshot-pieces", type=int, default=6, help="max pieces of the boards in a snapshot")
+    parser.add_argument("--playout", default="default", choices=sorted(PLAYOUTS))
+    parser.add_argument("--base", default=None, help="frozen model to start from")
+    parser.add_argument("--out", default=None, help="folder of the trained model (coordinator/local)")
+    args = parser.parse_args()
+    base = BaseTable.load(args.base, mmap=False) if args.base else None
+    if args.mode != "local":
+        try:
+            authkey = authkey_from(args.authkey)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.mode == "worker":
+        _run_worker((args.host, args.port), authkey, args.rollouts, args.batch, args.playout)
+    else:
+        if args.mode == "local":
+            model = train_local(args.workers, args.rollouts, args.batch, args.snapshot_every,
+                                args.snapshot_pieces, args.playout, base, args.port)
+        else:
+            model = Coordinator((args.host, args.port), args.workers, authkey, args.snapshot_every,
+                                args.snapshot_pieces, base).run()
+        if args.out:
+            model.save(args.out)
@@ -1,7 +1,6 @@
 from abc import ABC, abstractmethod
 from copy import deepcopy
 from enum import Enum
-import numpy as np
 from MCTS import Node
 from random import choice
 from time import sleep
@@ -14,7 +13,287 @@ LEFT_FRONTIER = [0,5,10,15,20]
 RIGHT_FRONTIER = [4,9,14,19,24]
 LOWER_FRONTIER = [20,21,22,23,24]
 
-
+### the 8 symmetries of the square, as maps of a (row, col) cell
+SYMMETRIES = [
+    lambda r, c: (r, c),            # identity
+    lambda r, c: (c, 4 - r),        # clockwise rotation
+    lambda r, c: (4 - r, 4 - c),    # half turn
+    lambda r, c: (4 - c, r),        # counterclockwise rotation
+    lambda r, c: (r, 4 - c),        # vertical symmetry
+    lambda r, c: (4 - r, c),        # horizontal symmetry
+    lambda r, c: (c, r),            # d1 symmetry
+    lambda r, c: (4 - c, 4 - r),    # d2 symmetry
+]
+
+
+def _row_images(sym):
+    '''Image under `sym` of every 5-bit pattern of every row of a (25-bit) half board'''
+    table = []
+    for r in range(5):
+        images = []
+        for v in range(32):
+            image = 0
+            for j in range(5):
+                if (v >> j) & 1:
+                    new_r, new_c = sym(r, 4 - j)
+                    image |= 1 << (24 - 5*new_r - new_c)
+            images.append(image)
+        table.append(images)
+    return table
+
+def _col_images(sym):
+    '''Same as _row_images for the columns, bit r of a pattern being the cell in row r'''
+    table = []
+    for c in range(5):
+        images = []
+        for v in range(32):
+            image = 0
+            for r in range(5):
+                if (v >> r) & 1:
+                    new_r, new_c = sym(r, c)
+                    image |= 1 << (24 - 5*new_r - new_c)
+            images.append(image)
+        table.append(images)
+    return table
+
+ROW_IMAGES = [_row_images(sym) for sym in SYMMETRIES]
+COL_IMAGES = [_col_images(sym) for sym in SYMMETRIES]
+
+### cross-check every incrementally derived hash against a full recomputation (slow, for debugging)
+VERIFY_HASHES = False
+
+
+def symmetric_images(board):
+    '''Returns the 8 images of the board under the symmetries of the square, with just table lookups'''
+    rows = [((board >> (20 - 5*r)) & 31, (board >> (52 - 5*r)) & 31) for r in range(5)]
+    images = []
+    for table in ROW_IMAGES:
+        o = 0
+        x = 0
+        for r, (o_row, x_row) in enumerate(rows):
+            o |= table[r][o_row]
+            x |= table[r][x_row]
+        images.append(o | (x << 32))
+    return images
+
+
+def canonical_board(board):
+    '''Smallest symmetric image of the board: the same integer for every board of a symmetry class'''
+    return min(symmetric_images(board))
+
+
+def symmetric_image(board, sym):
+    '''Image of the board under SYMMETRIES[sym] alone'''
+    table = ROW_IMAGES[sym]
+    o = 0
+    x = 0
+    for r in range(5):
+        o |= table[r][(board >> (20 - 5*r)) & 31]
+        x |= table[r][(board >> (52 - 5*r)) & 31]
+    return o | (x << 32)
+
+
+def _symmetry_index(f):
+    cells = [f(r, c) for r in range(5) for c in range(5)]
+    return next(i for i, sym in enumerate(SYMMETRIES) if [sym(r, c) for r in range(5) for c in range(5)] == cells)
+
+### symmetries by index: COMPOSE[a][b] applies b then a, INVERSE[a] undoes a
+COMPOSE = [[_symmetry_index(lambda r, c, a=a, b=b: a(*b(r, c))) for b in SYMMETRIES] for a in SYMMETRIES]
+INVERSE = [row.index(0) for row in COMPOSE]
+
+
+def line_images(diff, direction, row, col):
+    '''The 8 symmetric images of a board change confined to one line:
+        the row of a left/right move or the column of an up/down move'''
+    if direction == "left" or direction == "right":
+        shift = 20 - 5*row
+        o_v = (diff >> shift) & 31
+        x_v = (diff >> (shift + 32)) & 31
+        return [table[row][o_v] | (table[row][x_v] << 32) for table in ROW_IMAGES]
+    o_v = 0
+    x_v = 0
+    for r in range(5):
+        bit = 24 - 5*r - col
+        o_v |= ((diff >> bit) & 1) << r
+        x_v |= ((diff >> (bit + 32)) & 1) << r
+    return [table[col][o_v] | (table[col][x_v] << 32) for table in COL_IMAGES]
+
+
+def child_images(images, board, child, direction, row, col):
+    '''Symmetric images of `child` derived from those of its parent `board`: a move only changes
+        one line and the symmetries are bit permutations, so only the changed line is mapped'''
+    return [image ^ change for image, change in zip(images, line_images(board ^ child, direction, row, col))]
+
+
+def swap_board(board):
+    '''Returns the board with players swapped'''
+    return (board >> 32) | ((board << 32) & ((1 << 64) - 1))
+
+
+def _shift_masks(i, direction):
+    '''(B, C, shift) of a move: the moved line, the inserted piece and the shift (>0 means <<),
+        exactly as built by the State.shift_* methods'''
+    row, col = i // 5, i % 5
+    if direction == "right":
+        c_index = 24 - 5*row
+        cells, shift = range(c_index, c_index - (col + 1), -1), -1
+    elif direction == "left":
+        c_index = 24 - (5*row + 4)
+        cells, shift = range(c_index, c_index + (5 - col)), 1
+    elif direction == "up":
+        c_index = 24 - (col + 20)
+        cells, shift = range(c_index, c_index + (5 - row) * 5, 5), 5
+    else:
+        c_index = 24 - col
+        cells, shift = range(c_index, c_index - (row * 5) - 1, -5), -5
+    B = 0
+    for c in cells:
+        B |= (1 << c) | (1 << (c + 32))
+    return B, 1 << c_index, shift
+
+
+def _directions(i):
+    directions = ["up", "down", "left", "right"]
+    if i in UPPER_FRONTIER:
+        directions.remove("down")
+    elif i in LOWER_FRONTIER:
+        directions.remove("up")
+    if i in LEFT_FRONTIER:
+        directions.remove("right")
+    elif i in RIGHT_FRONTIER:
+        directions.remove("left")
+    return directions
+
+### compact move ids: 4 per frontier cell, one for each direction
+DIRECTIONS = ["up", "down", "left", "right"]
+MOVE_IDS = {(i, d): 4*k + DIRECTIONS.index(d) for k, i in enumerate(FRONTIER_INDEXES) for d in _directions(i)}
+
+### every move by id, as (cell, direction, B, C, shift) with the masks of the O player
+MOVES = [next(((i, d) + _shift_masks(i, d) for (i, d), m in MOVE_IDS.items() if m == move), None) for move in range(64)]
+
+### bitmask of the ids of the moves taking each frontier cell
+CELL_MOVE_MASKS = [(i, sum(1 << m for (c, _), m in MOVE_IDS.items() if c == i)) for i in FRONTIER_INDEXES]
+
+### the same move seen in a symmetric image of the board: SYMMETRY_MOVES[sym][move]
+_DIRECTION_VECTORS = {"up": (-1, 0), "down": (1, 0), "left": (0, -1), "right": (0, 1)}
+
+def _symmetric_move(sym, move):
+    if MOVES[move] is None:
+        return None
+    i, direction = MOVES[move][:2]
+    r, c = sym(i // 5, i % 5)
+    origin = sym(0, 0)
+    end = sym(*_DIRECTION_VECTORS[direction])
+    vector = (end[0] - origin[0], end[1] - origin[1])
+    image_direction = next(d for d, v in _DIRECTION_VECTORS.items() if v == vector)
+    return MOVE_IDS[(5*r + c, image_direction)]
+
+SYMMETRY_MOVES = [[_symmetric_move(sym, move) for move in range(64)] for sym in SYMMETRIES]
+
+
+def legal_moves(board, player):
+    '''Bitmask of the ids of the legal moves of `player`: all the moves taking
+        a frontier cell that is empty or already his'''
+    opponent = board if player == "X" else board >> 32
+    mask = 0
+    for i, cell_mask in CELL_MOVE_MASKS:
+        if not (opponent >> (24 - i)) & 1:
+            mask |= cell_mask
+    return mask
+
+
+def move_list(mask):
+    '''Move ids of a bitmask'''
+    ids = []
+    while mask:
+        low = mask & -mask
+        ids.append(low.bit_length() - 1)
+        mask ^= low
+    return ids
+
+
+def apply_move(board, move, player):
+    '''Board after `player` plays the (legal) move id `move`'''
+    _, _, B, C, shift = MOVES[move]
+    if player == "X":
+        C <<= 32    ### the shift is the same for both halves, only the inserted piece changes
+    if shift > 0:
+        return (((board & B) << shift) & B) | (board & ~B) | C
+    return (((board & B) >> -shift) & B) | (board & ~B) | C
+
+
+def move_children(board, player):
+    '''(child board, move id) of every move of `player` that changes the board'''
+    children = []
+    for move in move_list(legal_moves(board, player)):
+        child = apply_move(board, move, player)
+        if child != board:
+            children.append((child, move))
+    return children
+
+
+def move_boards(board, player, distinct=True):
+    '''
+    All the boards reachable by `player` in one move, as (board, row, col, direction) tuples.
+    Works on bare bitboards (no State is built) and skips the moves that leave the board unchanged;
+    if `distinct`, only one board per symmetry class is kept
+    '''
+    seen = set()
+    moves = []
+    for child, move in move_children(board, player):
+        if distinct:
+            key = canonical_board(child)
+            if key in seen:
+                continue
+            seen.add(key)
+        i, direction = MOVES[move][:2]
+        moves.append((child, i // 5, i % 5, direction))
+    return moves
+
+
+def board_winner(board):
+    '''"O" or "X" if the player has a line, "D" for a full board (draw), "-" otherwise'''
+    o_draw = board & 33554431
+    x_draw = (board >> 32) & 33554431
+    if o_draw | x_draw == 33554431:
+        return "D" #stands for draw
+    for o_comb in WINNING_COMBS:
+        if o_draw & o_comb == o_comb:
+            return "O"
+        elif x_draw & o_comb == o_comb:
+            return "X"
+    return "-"
+
+
+def line_threats(board):
+    '''Number of lines where O (resp. X) has 4 pieces out of 5'''
+    o = board & 33554431
+    x = (board >> 32) & 33554431
+    o_threats = 0
+    x_threats = 0
+    for comb in WINNING_COMBS:
+        if (o & comb).bit_count() == 4:
+            o_threats += 1
+        elif (x & comb).bit_count() == 4:
+            x_threats += 1
+    return o_threats, x_threats
+
+
+LINE_WEIGHTS = [0, 1, 4, 16, 64, 4096]
+
+def line_score(board):
+    '''Cheap evaluation of the board for O: lines still open to a player count more the fuller they are'''
+    o = board & 33554431
+    x = (board >> 32) & 33554431
+    score = 0
+    for comb in WINNING_COMBS:
+        o_count = (o & comb).bit_count()
+        x_count = (x & comb).bit_count()
+        if not x_count:
+            score += LINE_WEIGHTS[o_count]
+        if not o_count:
+            score -= LINE_WEIGHTS[x_count]
+    return score
 
 
 class Move(Enum):
@@ -26,6 +305,15 @@ class Move(Enum):
     LEFT = 2
     RIGHT = 3
 
+### direction of a move on the bitboard -> where the Game puts the taken piece
+SLIDES = {"up": Move.BOTTOM, "down": Move.TOP, "left": Move.RIGHT, "right": Move.LEFT}
+
+
+def game_move(move):
+    '''(from_pos, slide) of a move id, in the (X, Y) coordinates of the Game'''
+    i, direction = MOVES[move][:2]
+    return (i % 5, i // 5), SLIDES[direction]
+
 class Player(ABC):
     def __init__(self) -> None:
         '''You can change this for your player if you need to handle state/have memory'''
@@ -45,6 +333,7 @@ class Player(ABC):
 
 class Game(object):
     def __init__(self) -> None:
+        import numpy as np  ### only the Game itself needs numpy, the bitboard code does not
         self.current_board = State(0)
         self.current_player = "O"
         self._board = np.ones((5, 5), dtype=np.uint8) * -1
@@ -54,7 +343,7 @@ class Game(object):
       '''Prints the board. -1 are neutral pieces, 0 are pieces of player 0, 1 pieces of player 1'''
       print(self._board)
 
-    def get_board(self) -> np.ndarray:
+    def get_board(self) -> 'np.ndarray':
         '''
         Returns the board
         '''
@@ -65,6 +354,28 @@ class Game(object):
     def set_board(self, board):
         self.current_board = State(board)
 
+    def bitboard(self) -> int:
+        '''
+        Returns the board as a 64-bit integer (see State): the pieces of player 0 are the Os
+        '''
+        ret = 0
+        for i in range(5):
+            for j in range(5):
+                if self._board[i, j] == 0:
+                    ret |= 1 << (24 - 5*i - j)
+                elif self._board[i, j] == 1:
+                    ret |= 1 << (32 + (24 - 5*i - j))
+        return ret
+
+    def legal_moves(self, player_id=None) -> list:
+        '''
+        Returns the legal (from_pos, slide) moves of a player, the current one by default
+        '''
+        if player_id is None:
+            player_id = self.current_player_idx
+        player = "O" if player_id == 0 else "X"
+        return [game_move(m) for m in move_list(legal_moves(self.bitboard(), player))]
+
     def get_current_player(self) -> int:
         '''
         Returns the current player
@@ -113,10 +424,11 @@ class Game(object):
             self.current_player_idx += 1
             self.current_player_idx %= len(players)
             ok = False
+            legal = set(self.legal_moves())
             while not ok:
                 from_pos, slide = players[self.current_player_idx].make_move(
                     self)
-                ok = self.__move(from_pos, slide, self.current_player_idx)
+                ok = (tuple(from_pos), slide) in legal and self.__move(from_pos, slide, self.current_player_idx)
             self.print()
             print()
             winner = self.check_winner()
@@ -239,15 +551,45 @@ class Game(object):
 class State(Node):
 
 
-    def __init__(self,board, row=None, col=None, direction=None) -> None:
+    parent = None  # States pickled before parents were recorded
+
+    def __init__(self,board, row=None, col=None, direction=None, images=None, parent=None) -> None:
         super().__init__()
         self.board = board
+        ### parent: the board the move (row, col, direction) was played on. Its frame may differ
+        ### from the one of the node the tree reached this State from (see align_path)
+        self.parent = parent
         self.moves = dict()
         self.current_player = "X"
         self.row = row
         self.col = col
         self.direction = direction
-        self.hash_key = self.generate_hash_key(self.board)
+        ### images: the 8 symmetric images of the board, when derived incrementally from the parent
+        if images is None:
+            images = symmetric_images(board)
+        elif VERIFY_HASHES and list(images) != symmetric_images(board):
+            raise RuntimeError(f"incremental hash of board {board} does not match its symmetries")
+        self.images = images
+        self.hash_key = min(images)
+        self.canonical = self.hash_key
+
+    ### pickled States were hashed with the old (non canonical) keys: rehash them on load
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("images", None)  # cheap to recompute, no need to store them
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.images = None
+        if state.get("canonical") is None or state["canonical"] != state.get("hash_key"):
+            self.hash_key = canonical_board(self.board)
+            self.canonical = self.hash_key
+
+    def get_images(self):
+        if self.images is None:
+            self.images = symmetric_images(self.board)
+        return self.images
 
     
     def set_board(self, board) -> None:
@@ -467,72 +809,38 @@ class State(Node):
                 return 0
         return 1
 
-    def generate_moves(self, pos, player) -> list:
-        moves = list()
-
-        frontiers = [UPPER_FRONTIER, LOWER_FRONTIER, LEFT_FRONTIER, RIGHT_FRONTIER]
-
-        for frontier in frontiers:
-            for i in frontier:
-                occupied = (pos >> 32) << i
-                occupied &= 16777216
-
-                if occupied != 16777216:
-                    directions = ["up", "down", "left", "right"]
-
-                    if i in UPPER_FRONTIER:
-                        directions.remove("down")
-                    elif i in LOWER_FRONTIER:
-                        directions.remove("up")
-                    if i in LEFT_FRONTIER:
-                        directions.remove("right")
-                    elif i in RIGHT_FRONTIER:
-                        directions.remove("left")
-
-                    for direction in directions:
-                        add = getattr(self, f"shift_{direction}")("O", i // 5, i % 5, pos)
-                        moves_boards = []
-                        for m in moves:
-                            if player=="X":
-                                moves_boards.append(self.swap_players(m.board))
-                            else:
-                                moves_boards.append(m.board)
-                        if self.check_symmetries(moves_boards, add) != 0 and add!=pos:
-                            ### ADDING MOVE
-                            new_state = State(self.swap_players(add) if player == "X" else add, 
-                                            row = i//5, col=i%5, direction=direction)
-                            moves.append(new_state)
+    def child_moves(self, player):
+        '''(board, row, col, direction, images) of the children, one per symmetry class.
+            The images of each child are derived from this board's, no symmetry is recomputed'''
+        images = self.get_images()
+        seen = set()
+        moves = []
+        for child, move in move_children(self.board, player):
+            i, direction = MOVES[move][:2]
+            row, col = i // 5, i % 5
+            child_imgs = child_images(images, self.board, child, direction, row, col)
+            key = min(child_imgs)
+            if key not in seen:
+                seen.add(key)
+                moves.append((child, row, col, direction, child_imgs))
         return moves
 
+    def generate_moves(self, player) -> list:
+        return [State(child, row=row, col=col, direction=direction, images=images, parent=self.board)
+                for child, row, col, direction, images in self.child_moves(player)]
+
     ### wrapper for generate_moves
     def create_position(self, player, in_game=False) -> list:
         '''
-        Generates all possible moves for player O, given a certain board
+        Generates all possible moves for player, given a certain board
         '''
-        if player == "X":               ###always works on Os
-            board = self.swap_players(self.board)       
-        moves = self.generate_moves(board if player == "X" else self.board, player)
-        if player == "X":               ###always works on Os
-            board = self.swap_players(self.board)  
-        return moves
+        return self.generate_moves(player)
 
 
 
     #### CHECK WINNER
     def check_winner(self):
-        o_draw = self.board & 33554431
-        x_draw = (self.board >> 32) & 33554431
-        if o_draw | x_draw == 33554431:
-            return "D" #stands for draw
-        for o_comb in WINNING_COMBS:
-            x_comb = o_comb << 32
-            o_and = self.board & o_comb
-            x_and = self.board & x_comb
-            if o_and == o_comb:
-                return "O"
-            elif x_and == x_comb:
-                return "X"
-        return "-"
+        return board_winner(self.board)
     
 
     ### aggiustato
@@ -544,17 +852,26 @@ class State(Node):
         return self.create_position(player)
 
 
+    def find_ordered_children(self, player):
+        '''Successors of this board state, most promising first (completing or blocking lines).
+            States are only built when requested, so that a node can be expanded progressively'''
+        sign = 1 if player == "O" else -1
+        moves = sorted(self.child_moves(player), key=lambda m: sign * line_score(m[0]), reverse=True)
+        for board, row, col, direction, images in moves:
+            yield State(board, row=row, col=col, direction=direction, images=images, parent=self.board)
+
      
     def find_random_child(self, player=None):
         '''Returns a random move'''
-        return choice(self.create_position(player)) 
+        board, row, col, direction, images = choice(self.child_moves(player))
+        return State(board, row=row, col=col, direction=direction, images=images, parent=self.board)
 
     
     def find_the_child(self, monteQ, player=None, reverse=False):
         '''Returns the best move'''
         if reverse:
-            return min(self.create_position(player), key=lambda y: monteQ[y] if y in monteQ.keys() else float("inf"))
-        return max(self.create_position(player), key=lambda y: monteQ[y] if y in monteQ.keys() else float("-inf"))
+            return min(self.create_position(player), key=lambda y: monteQ[y] if y in monteQ else float("inf"))
+        return max(self.create_position(player), key=lambda y: monteQ[y] if y in monteQ else float("-inf"))
 
 
     def is_terminal(self):
@@ -577,12 +894,58 @@ class State(Node):
 
     ### utility to actually hash at symmetry/rotation level
     def generate_hash_key(self, board):
-        sym = [self.board, self.vertical_symmetry(board), self.horizontal_symmetry(board),
-                     self.d1_symmetry(board), self.d2_symmetry(board), self.rotate_clockwise(board),
-                        self.rotate_counterclockwise(board)]
-        symset = set(sym)
-        return sum(list(symset))
+        return canonical_board(board)
     
+    def game_move(self):
+        '''(from_pos, slide) of the move that led to this board, as expected by the Game'''
+        return game_move(self.move_id())
+
+    def move_id(self):
+        '''Id of the move that led to this board (see MOVE_IDS), None for a root board'''
+        if self.direction is None:
+            return None
+        return MOVE_IDS[(5*self.row + self.col, self.direction)]
+
+    def child_frame(self, child):
+        '''Symmetry mapping this board onto the board `child` was generated from'''
+        return self.get_images().index(self.board if child.parent is None else child.parent)
+
+    def amaf_move(self, move, frame=0):
+        '''Key of a move for the AMAF statistics of this node: `move`, given in the frame of
+            the image `frame` of this board, mapped into the frame of the canonical board'''
+        if move is None:
+            return None
+        canonical = self.get_images().index(self.hash_key)
+        return SYMMETRY_MOVES[COMPOSE[canonical][INVERSE[frame]]][move]
+
+    def align_path(self, path, moves=None, boards=None):
+        '''
+        The moves of a rollout from this node (the tree `path`, then the playout `moves`) and
+        its boards (if the playout `boards` are given), all in the frame of this board, and for
+        each node of the path the symmetry mapping its own board into that frame.
+        The nodes of the tree are shared by all the symmetric boards, so two consecutive nodes
+        of a path need not be in the same frame
+        '''
+        frames = [0]
+        sequence = []
+        for previous, node in zip(path, path[1:]):
+            frame = COMPOSE[frames[-1]][INVERSE[previous.child_frame(node)]]
+            frames.append(frame)
+            move = node.move_id()
+            sequence.append(None if move is None else SYMMETRY_MOVES[frame][move])
+        leaf = frames[-1]
+        ### the playout starts from the board of the leaf node and stays in its frame
+        sequence += [None if move is None else SYMMETRY_MOVES[leaf][move] for move in moves or ()]
+        if boards is not None:
+            boards = [node.get_images()[frame] for node, frame in zip(path, frames)] + \
+                     [symmetric_image(board, leaf) if leaf else board for board in boards]
+        return sequence, boards, frames
+
+    ### key of the board in the frozen Q/N tables (see tables.py)
+    def canonical_key(self):
+        '''Symmetry-invariant integer key of the board'''
+        return self.hash_key
+
     ### made it resistant to symmetry/rotation
     def __hash__(self):
         "Nodes must be hashable"
@@ -591,8 +954,42 @@ class State(Node):
     ### resistant to symmetry/rotation
     def __eq__(self,node2):
         "Nodes must be comparable" 
-        board_with_sym = self.generate_symmetries(self.board)   
-        for b in board_with_sym:
-            if b.board == node2.board:
-                return True            
-        return False
\ No newline at end of file
+        return self.hash_key == node2.hash_key   ### canonical boards: equal iff one is a symmetry of the other
+
+### LOADING PICKLED Q/N TABLES
+
+class _SummingDict(dict):
+    "Adds the values of equal keys instead of overwriting them"
+
+    def __setitem__(self, key, value):
+        if key in self:
+            value = self[key] + value
+        super().__setitem__(key, value)
+
+
+def _summing_defaultdict(default_factory=None, *args):
+    table = _SummingDict(*args)
+    table.default_factory = default_factory
+    return table
+
+
+def load_table(file):
+    '''
+    Loads a pickled Q or N table (a defaultdict keyed by States) from an open binary file.
+    The States of older pickles were keyed by a hash that kept some symmetric boards apart;
+    they are rehashed on load and now compare equal, so their values are summed into one entry
+    instead of the last one silently replacing the others
+    '''
+    import pickle
+    from collections import defaultdict
+
+    class SummingUnpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            if (module, name) == ("collections", "defaultdict"):
+                return _summing_defaultdict
+            return super().find_class(module, name)
+
+    table = SummingUnpickler(file).load()
+    if isinstance(table, _SummingDict):
+        return defaultdict(table.default_factory, table)
+    return table
@@ -1,9 +1,12 @@
+import time
+_START = time.perf_counter()  # for the startup latency reported by the command line
 import random
 from game import Game, Move, Player, State
 from MCTS import MCTS
-from tqdm import tqdm
+from ponder import Ponderer
 from collections import defaultdict
-import pickle
+### numpy (tables, distributed), tqdm and pickle are imported where they are used:
+### a process that only answers one move query never loads them
 
 
 class RandomPlayer(Player):
@@ -11,9 +14,7 @@ class RandomPlayer(Player):
         super().__init__()
 
     def make_move(self, game: 'Game') -> tuple[tuple[int, int], Move]:
-        from_pos = (random.randint(0, 4), random.randint(0, 4))
-        move = random.choice([Move.TOP, Move.BOTTOM, Move.LEFT, Move.RIGHT])
-        return from_pos, move
+        return random.choice(game.legal_moves())
 
 class OffMonteCarloPlayer(Player):
     def __init__(self, train_with_checkpoints=True, load_model=False, log_folder = None) -> None:
@@ -21,49 +22,48 @@ class OffMonteCarloPlayer(Player):
         self.checkpoint = train_with_checkpoints
         self.log_folder = log_folder
         self.my_symbol = "-"
-        
-        if load_model:
-          q,n = self.load_model(log_folder)
-          self.tree = MCTS(q=q, n=n)
-          print(f"succesfully loaded Q (len {len(self.tree.Q)}) and N (len {len(self.tree.N)})")            
-        else:
-            self.tree = MCTS()
+        ### the model is only loaded when the tree is first needed
+        self.load = load_model
+        self._tree = None
 
+    @property
+    def tree(self):
+        if self._tree is None:
+            if self.load:
+                q,n = self.load_model(self.log_folder)
+                self._tree = MCTS(q=q, n=n)
+                print(f"succesfully loaded Q (len {len(self._tree.Q)}) and N (len {len(self._tree.N)})")
+            else:
+                self._tree = MCTS()
+        return self._tree
 
+    @tree.setter
+    def tree(self, tree):
+        self._tree = tree
 
     def make_move(self, game: 'Game') -> tuple[tuple[int, int], Move]:
         
-        def fromNumPy(np_board):
-          rows, cols = np_board.shape
-          ret = 0
-          for i in range(rows):
-              for j in range(cols):
-                  if np_board[i,j]==0:
-                    ret |= 1 << (24 - 5*i - j) 
-                  elif np_board[i,j]==1:
-                    ret |= 1 << (32 + (24 - 5*i - j)) 
-          return ret      
-        
         self.my_symbol = "O" if game.current_player_idx==0 else "X"
         opponent = "O" if self.my_symbol=="X" else "X"
         print(f"MC plays {self.my_symbol}")
 
         ### some manipulation between our data structures and the given ones
-        binary_current_board = fromNumPy(game._board)
+        binary_current_board = game.bitboard()
         ret_board = self.tree.choose(State(binary_current_board), opponent=opponent) 
 
-        from_pos = (ret_board.col, ret_board.row)
-        if ret_board.direction=="up":
-            move = Move.BOTTOM
-        elif ret_board.direction=="down":
-            move = Move.TOP
-        elif ret_board.direction=="left":
-            move = Move.RIGHT
-        elif ret_board.direction=="right":
-            move = Move.LEFT            
-        return from_pos, move
+        return ret_board.game_move()
         
-    def train(self):
+    def train(self, coordinator=None, workers=None, trajectories=None, authkey=None):
+        ### coordinator: (host, port) of a distributed training (see distributed.py).
+        ### with `workers` this player is the coordinator and waits for them, else it is one of the workers
+        ### authkey: shared secret of the training, QUIXO_AUTHKEY if None (there is no default)
+        if coordinator is not None:
+            return self.train_distributed(coordinator, workers, authkey=authkey)
+        ### trajectories: file where every rollout is recorded (see trajectories.py)
+        if trajectories is not None:
+            from trajectories import TrajectoryRecorder
+            self.tree.recorder = TrajectoryRecorder(trajectories)
+        from tqdm import tqdm
         epochs = range(100000)
         self.age = epochs
         save =0
@@ -77,8 +77,24 @@ class OffMonteCarloPlayer(Player):
                 n_check+=1
         self.save_model(self.log_folder+f"/last_q", self.log_folder+f"/last_n")
         self.save_age()
+        if self.tree.recorder is not None:
+            self.tree.recorder.close()
+            self.tree.recorder = None
+
+    def train_distributed(self, coordinator, workers=None, rollouts=100000, authkey=None):
+        from distributed import Coordinator, Worker, authkey_from
+        authkey = authkey_from(authkey)
+        if workers is None:
+            print(f"Training as a worker of {coordinator}....")
+            Worker(coordinator, rollouts, authkey).run()
+            return
+        model = Coordinator(coordinator, workers, authkey).run()
+        q,n = model.layered()
+        self.tree = MCTS(q=q, n=n)
+        model.save(self.log_folder+"/base")
 
     def save_model(self, path_q, path_n):
+        import pickle
         try:
           with open(path_q, 'wb') as file:
             pickle.dump(self.tree.Q, file)
@@ -91,15 +107,26 @@ class OffMonteCarloPlayer(Player):
 
     
     def save_age(self):
+        import pickle
         with open('MCplayer ages', 'wb') as file:
             pickle.dump(self.age, file)
 
+    def freeze_model(self, path):
+        '''Saves Q and N as a read-only base model, that many MixedMonteCarloPlayers can share'''
+        from tables import BaseTable, LayeredTable
+        if isinstance(self.tree.N, LayeredTable):
+            ### after a distributed training the tree is a fresh overlay on the master table
+            self.tree.N.base.save(path)
+            return
+        BaseTable.from_model(self.tree.Q, self.tree.N).save(path)
+
     def load_model(self, path):
+        from game import load_table
         try:
             with open(path+"/q_0", 'rb') as file:
-                q = pickle.load(file) 
+                q = load_table(file)
             with open(path+"/n_0", 'rb') as file:
-                n = pickle.load(file) 
+                n = load_table(file)
             return q, n
         except FileNotFoundError:
             print("Q or N file not found. Loading empty dictionaries....")
@@ -110,99 +137,98 @@ class OffMonteCarloPlayer(Player):
 
 
 class OnMonteCarloPlayer(Player):
-    def __init__(self,step=50) -> None:
+    def __init__(self,step=50, ponder=False) -> None:
         super().__init__()
         self.step = step
         self.my_symbol = "-"
         self.tree = MCTS()
+        ### ponder: keep rolling out during the opponent's turn
+        self.ponderer = Ponderer(self.tree) if ponder else None
 
     def make_move(self, game: 'Game') -> tuple[tuple[int, int], Move]:
+        if self.ponderer is not None:
+            print(f"pondered {self.ponderer.stop()} rollouts")
         
-        def fromNumPy(np_board):
-          rows, cols = np_board.shape
-          ret = 0
-          for i in range(rows):
-              for j in range(cols):
-                  if np_board[i,j]==0:
-                    ret |= 1 << (24 - 5*i - j) 
-                  elif np_board[i,j]==1:
-                    ret |= 1 << (32 + (24 - 5*i - j)) 
-          return ret      
-                 
         self.my_symbol = "O" if game.current_player_idx==0 else "X"
         opponent = "O" if self.my_symbol=="X" else "X"
         print(f"MC plays {self.my_symbol}")
 
 
-        binary_current_board = fromNumPy(game._board)
+        binary_current_board = game.bitboard()
         
+        from tqdm import tqdm
         epochs = range(self.step)
         for item in tqdm(epochs, desc="Rolling...", unit="item"):
-          self.tree.do_rollout(State(binary_current_board))
+          self.tree.do_rollout(State(binary_current_board), self.my_symbol)
         ret_board = self.tree.choose(State(binary_current_board), opponent=opponent) 
 
-        from_pos = (ret_board.col, ret_board.row)
-        if ret_board.direction=="up":
-            move = Move.BOTTOM
-        elif ret_board.direction=="down":
-            move = Move.TOP
-        elif ret_board.direction=="left":
-            move = Move.RIGHT
-        elif ret_board.direction=="right":
-            move = Move.LEFT            
-        return from_pos, move
+        if self.ponderer is not None:
+            self.ponderer.start(State(ret_board.board), opponent)
+        return ret_board.game_move()
+
+    def stop_pondering(self):
+        if self.ponderer is not None:
+            self.ponderer.stop()
 
 class MixedMonteCarloPlayer(Player):
-    def __init__(self, train_with_checkpoints=True, load_model=False, log_folder = None, step=100) -> None:
+    def __init__(self, train_with_checkpoints=True, load_model=False, log_folder = None, step=100, base_model=None, ponder=False) -> None:
         super().__init__()
         self.checkpoint = train_with_checkpoints
         self.log_folder = log_folder
         self.my_symbol = "-"
         self.step = step
-        
-        if load_model:
-          q,n = self.load_model(log_folder)
-          self.tree = MCTS(q=q, n=n)
-          print(f"succesfully loaded Q (len {len(self.tree.Q)}) and N (len {len(self.tree.N)})")            
-        else:
-            self.tree = MCTS()
-
+        ### base_model: folder (or already loaded BaseTable) of a frozen model.
+        ### the base is shared read-only, the rollouts of this game only go in the overlays
+        self.base_model = base_model
+        self.load = load_model
+        ### ponder: keep rolling out during the opponent's turn
+        self.ponder = ponder
+        self.ponderer = None
+        ### the model is only loaded (memory-mapped for a base model) when the tree is first needed
+        self._tree = None
 
+    @property
+    def tree(self):
+        if self._tree is None:
+            if self.base_model is not None:
+                from tables import BaseTable
+                if not isinstance(self.base_model, BaseTable):
+                    self.base_model = BaseTable.load(self.base_model)
+                q,n = self.base_model.layered()
+                self._tree = MCTS(q=q, n=n)
+                print(f"succesfully attached base model (len {len(self.base_model)})")
+            elif self.load:
+                q,n = self.load_model(self.log_folder)
+                self._tree = MCTS(q=q, n=n)
+                print(f"succesfully loaded Q (len {len(self._tree.Q)}) and N (len {len(self._tree.N)})")
+            else:
+                self._tree = MCTS()
+            self.ponderer = Ponderer(self._tree) if self.ponder else None
+        return self._tree
 
     def make_move(self, game: 'Game') -> tuple[tuple[int, int], Move]:
-        
-        def fromNumPy(np_board):
-          rows, cols = np_board.shape
-          ret = 0
-          for i in range(rows):
-              for j in range(cols):
-                  if np_board[i,j]==0:
-                    ret |= 1 << (24 - 5*i - j) 
-                  elif np_board[i,j]==1:
-                    ret |= 1 << (32 + (24 - 5*i - j)) 
-          return ret      
+        if self.ponderer is not None:
+            print(f"pondered {self.ponderer.stop()} rollouts")
         
         self.my_symbol = "O" if game.current_player_idx==0 else "X"
         opponent = "O" if self.my_symbol=="X" else "X"
         print(f"MC plays {self.my_symbol}")
 
 
-        binary_current_board = fromNumPy(game._board)
+        binary_current_board = game.bitboard()
         for _ in range(self.step):
-          self.tree.do_rollout(State(binary_current_board))
+          self.tree.do_rollout(State(binary_current_board), self.my_symbol)
         ret_board = self.tree.choose(State(binary_current_board), opponent=opponent) 
-        from_pos = (ret_board.col, ret_board.row)
-        if ret_board.direction=="up":
-            move = Move.BOTTOM
-        elif ret_board.direction=="down":
-            move = Move.TOP
-        elif ret_board.direction=="left":
-            move = Move.RIGHT
-        elif ret_board.direction=="right":
-            move = Move.LEFT            
-        return from_pos, move
+        if self.ponderer is not None:
+            self.ponderer.start(State(ret_board.board), opponent)
+        return ret_board.game_move()
+
+    def stop_pondering(self):
+        if self.ponderer is not None:
+            self.ponderer.stop()
         
     def train(self):
+        from tqdm import tqdm
         epochs = range(100000)
         self.age = epochs
         save =0
@@ -218,6 +244,7 @@ class MixedMonteCarloPlayer(Player):
         self.save_age()
 
     def save_model(self, path_q, path_n):
+        import pickle
         try:
           with open(path_q, 'wb') as file:
             pickle.dump(self.tree.Q, file)
@@ -230,15 +257,17 @@ class MixedMonteCarloPlayer(Player):
 
     
     def save_age(self):
+        import pickle
         with open('MCplayer ages', 'wb') as file:
             pickle.dump(self.age, file)
 
     def load_model(self, path):
+        from game import load_table
         try:
             with open(path+"/q_0", 'rb') as file:
-                q = pickle.load(file) 
+                q = load_table(file)
             with open(path+"/n_0", 'rb') as file:
-                n = pickle.load(file) 
+                n = load_table(file)
             return q, n
         except FileNotFoundError:
             print("Q or N file not found. Loading empty dictionaries....")
@@ -247,15 +276,126 @@ class MixedMonteCarloPlayer(Player):
             print(f"Error: {e}")
             raise
 
+def make_player(kind, model=None, base_model=None, step=100):
+    '''Player of the command line. model: log folder of q/n pickles, base_model: frozen model folder'''
+    if base_model is not None and kind != "mixed":
+        raise ValueError(f"the {kind} player cannot use a base model, only the mixed one")
+    if model is not None and kind in ("random", "online"):
+        raise ValueError(f"the {kind} player has no model to load")
+    if kind == "random":
+        return RandomPlayer()
+    elif kind == "offline":
+        return OffMonteCarloPlayer(train_with_checkpoints=False, load_model=model is not None, log_folder=model)
+    elif kind == "online":
+        return OnMonteCarloPlayer(step=step)
+    return MixedMonteCarloPlayer(train_with_checkpoints=False, load_model=model is not None, log_folder=model,
+                                 step=step, base_model=base_model)
+
+
+class TimedPlayer(Player):
+    "Wraps a player, timing its first move"
+
+    def __init__(self, player) -> None:
+        super().__init__()
+        self.player = player
+        self.first_move = None
+
+    def make_move(self, game: 'Game') -> tuple[tuple[int, int], Move]:
+        start = time.perf_counter()
+        move = self.player.make_move(game)
+        if self.first_move is None:
+            self.first_move = time.perf_counter() - start
+        return move
+
+
+def report(startup, first_move):
+    print(f"startup: {1000 * startup:.1f} ms, first move: {1000 * first_move:.1f} ms")
+
+
+def query_move(board, to_move="O", model=None, base_model=None, rollouts=0):
+    '''Best move of `to_move` on a bitboard, as ((X, Y), Move), without building a Game'''
+    player = make_player("mixed" if model or base_model else "online", model, base_model)
+    opponent = "X" if to_move == "O" else "O"
+    node = State(board)
+    for _ in range(rollouts):
+        player.tree.do_rollout(node, to_move)
+    return player.tree.choose(node, opponent=opponent, verbose=False).game_move()
+
+
 if __name__ == '__main__':
-    g = Game()
+    import argparse
+    parser = argparse.ArgumentParser(description="Quixo Monte Carlo players")
+    commands = parser.add_subparsers(dest="command", required=True)
+    players = ["random", "offline", "online", "mixed"]
+
+    train = commands.add_parser("train", help="offline training from the empty board")
+    train.add_argument("--log-folder", required=True, help="folder of the q/n checkpoints")
+    train.add_argument("--no-checkpoints", action="store_true")
+    train.add_argument("--trajectories", default=None, help="file where every rollout is recorded")
+    train.add_argument("--freeze", default=None, help="also save the trained model as a base model here")
+    train.add_argument("--coordinator", default=None, help="host:port of a distributed training")
+    train.add_argument("--workers", type=int, default=None, help="be the coordinator, waiting for this many workers")
+    train.add_argument("--authkey", default=None, help="shared secret of a distributed training, default $QUIXO_AUTHKEY")
+
+    for name, help in (("play", "play one game"), ("evaluate", "play many games, report the score")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("--player", choices=players, default="mixed")
+        command.add_argument("--opponent", choices=players, default="random")
+        command.add_argument("--model", default=None, help="log folder of q/n pickles of the player")
+        command.add_argument("--base-model", default=None, help="frozen model of the mixed player (memory-mapped)")
+        command.add_argument("--step", type=int, default=100, help="rollouts per move of the online players")
+    commands.choices["evaluate"].add_argument("--games", type=int, default=10)
 
-    ### GAME ###
-    random_player = RandomPlayer()
-    mc_player = OffMonteCarloPlayer(load_model=True, log_folder=r"your/log/path")
-    mixed_player =  MixedMonteCarloPlayer(load_model=True, log_folder=r"your/log/path")
-    #winner = g.play(mixed_player, random_player)
-    #print(f"Winner : Player {winner}")
+    query = commands.add_parser("query-move", help="best move on a board, for short-lived jobs")
+    query.add_argument("board", type=lambda text: int(text, 0), help="64-bit board (see State), e.g. 0 or 0x...")
+    query.add_argument("--to-move", choices=["O", "X"], default="O")
+    query.add_argument("--model", default=None)
+    query.add_argument("--base-model", default=None)
+    query.add_argument("--rollouts", type=int, default=0, help="rollouts from the board before choosing")
+    args = parser.parse_args()
 
-    ### TRAINING ###
-    #mc_player.train()
+    if args.command == "train":
+        if args.freeze is not None and args.coordinator is not None and args.workers is None:
+            parser.error("--freeze with --coordinator needs --workers: a worker has no model to freeze")
+        player = OffMonteCarloPlayer(train_with_checkpoints=not args.no_checkpoints, log_folder=args.log_folder)
+        coordinator = None
+        if args.coordinator is not None:
+            host, port = args.coordinator.rsplit(":", 1)
+            coordinator = (host, int(port))
+        player.train(coordinator, args.workers, args.trajectories, args.authkey)
+        if args.freeze is not None:
+            player.freeze_model(args.freeze)
+
+    elif args.command == "query-move":
+        startup = time.perf_counter() - _START
+        start = time.perf_counter()
+        (x, y), slide = query_move(args.board, args.to_move, args.model, args.base_model, args.rollouts)
+        print(f"from ({x}, {y}) slide {slide.name}")
+        report(startup, time.perf_counter() - start)
+
+    else:
+        import contextlib, io
+        try:
+            player = TimedPlayer(make_player(args.player, args.model, args.base_model, args.step))
+        except ValueError as error:
+            parser.error(str(error))
+        opponent = make_player(args.opponent, step=args.step)
+        startup = time.perf_counter() - _START
+        games = 1 if args.command == "play" else args.games
+        score = 0
+        for i in range(games):
+            g = Game()
+            ### the player moves first in the even games
+            first, second = (player, opponent) if i % 2 == 0 else (opponent, player)
+            if args.command == "play":
+                winner = g.play(first, second)
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    winner = g.play(first, second)
+            score += winner == i % 2
+            print(f"game {i}: winner player {winner} ({'player' if winner == i % 2 else 'opponent'})")
+            for p in (player.player, opponent):
+                if hasattr(p, "stop_pondering"):
+                    p.stop_pondering()
+        print(f"{args.player} won {score} of {games} games against {args.opponent}")
+        report(startup, player.first_move)
@@ -0,0 +1,102 @@
+"""
+Playout policies for MCTS._simulate.
+
+A policy plays the whole simulation on bare bitboards, so no State (and no symmetry hash)
+is built for the positions of a playout. After `max_length` moves the playout is cut and
+the board is scored with a cheap line evaluation, on the same scale as State.reward
+(3 = O wins, 1 = draw, -1 = X wins).
+"""
+import math
+from random import random, choice
+from game import move_children, board_winner, line_threats, line_score
+
+
+THREAT_WEIGHT = 64  # a 4-in-a-line with the 5th cell taken by the opponent is still a threat in Quixo
+EVALUATION_SCALE = 256
+
+
+def evaluate(board):
+    '''Heuristic reward of a non terminal board, between -1 (X wins) and 3 (O wins)'''
+    o_threats, x_threats = line_threats(board)
+    score = line_score(board) + THREAT_WEIGHT * (o_threats - x_threats)
+    return 1 + 2 * math.tanh(score / EVALUATION_SCALE)
+
+
+def terminal_reward(winner):
+    if winner == "O":
+        return 3
+    elif winner == "D":
+        return 1
+    return -1
+
+
+class RandomPlayout:
+    '''Uniformly random moves until the game ends, or for `max_length` moves.
+        With a `tablebase` (see tablebase.py) the playout stops at the first position it knows'''
+
+    def __init__(self, max_length=None, tablebase=None):
+        self.max_length = max_length
+        self.tablebase = tablebase
+
+    def choose(self, board, player):
+        "Returns the move of `player`, as a (board, move id) tuple"
+        return choice(move_children(board, player))
+
+    def simulate(self, node, turn, moves=None, boards=None):
+        "Returns the reward of a playout from `node`, with `turn` to move. The move ids are appended to `moves`, the boards to `boards`"
+        board = node.board
+        length = 0
+        while True:
+            winner = board_winner(board)
+            if winner != "-":
+                return terminal_reward(winner)
+            if self.tablebase is not None:
+                reward = self.tablebase.reward(board, turn)
+                if reward is not None:
+                    return reward
+            if self.max_length is not None and length >= self.max_length:
+                return evaluate(board)
+            board, move = self.choose(board, turn)
+            if moves is not None:
+                moves.append(move)
+            if boards is not None:
+                boards.append(board)
+            turn = "X" if turn == "O" else "O"
+            length += 1
+
+
+class HeuristicPlayout(RandomPlayout):
+    '''
+    Plays an immediate win if there is one, never hands a line to the opponent, and otherwise
+    prefers the moves that leave the most own threats and the fewest opponent ones.
+    A random move is played with probability `epsilon`, to keep the playouts diverse.
+    '''
+
+    def __init__(self, max_length=40, epsilon=0.1, tablebase=None):
+        super().__init__(max_length, tablebase)
+        self.epsilon = epsilon
+
+    def choose(self, board, player):
+        moves = move_children(board, player)
+        if random() < self.epsilon:
+            return choice(moves)
+        best = None
+        best_score = -math.inf
+        for move in moves:
+            child = move[0]
+            winner = board_winner(child)
+            if winner == player:
+                return move
+            if winner != "-" and winner != "D":
+                continue  # losing move, the line is the opponent's
+            o_threats, x_threats = line_threats(child)
+            if player == "O":
+                score = o_threats - 2 * x_threats
+            else:
+                score = x_threats - 2 * o_threats
+            score += random()  # random tie-break
+            if score > best_score:
+                best, best_score = move, score
+        if best is None:
+            return choice(moves)  # every move loses
+        return best
@@ -0,0 +1,46 @@
+"""
+Background pondering for the online Monte Carlo players.
+
+After playing its move, a player keeps running rollouts from the resulting position
+(with the opponent to move) in a background thread. When its next turn comes the thread
+is stopped: the tree is a transposition table, so the statistics gathered for the position
+the opponent actually chose are already there and the player just continues from them.
+
+Rollouts are pure Python, so pondering only gains time when the opponent does not need
+this interpreter to think (a human, a remote client, another process).
+"""
+import threading
+
+
+class Ponderer:
+    "Runs `tree.do_rollout` from a position in a background thread, until stopped"
+
+    def __init__(self, tree, max_rollouts=None):
+        self.tree = tree
+        self.max_rollouts = max_rollouts  # bound on the rollouts of one pondering session (memory)
+        self.thread = None
+        self.stop_event = None
+        self.rollouts = 0
+
+    def start(self, node, player):
+        "Starts pondering on `node`, with `player` to move"
+        self.stop()
+        self.rollouts = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(node, player, self.stop_event), daemon=True)
+        self.thread.start()
+
+    def _run(self, node, player, stop_event):
+        while not stop_event.is_set():
+            if self.max_rollouts is not None and self.rollouts >= self.max_rollouts:
+                return
+            self.tree.do_rollout(node, player)
+            self.rollouts += 1
+
+    def stop(self):
+        "Stops pondering (the current rollout is completed), returns the number of rollouts done"
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        return self.rollouts
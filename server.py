@@ -0,0 +1,281 @@
+"""
+Asyncio match server: many concurrent Quixo games against our Monte Carlo player.
+
+Clients connect over TCP (or a unix socket) and exchange newline-delimited JSON:
+
+    {"op": "new", "first": "client", "opponent": "online", "rollouts": 50}
+        -> {"game": 0, "you": "O", "board": 0, "winner": "-"}
+    {"op": "move", "game": 0, "from": [0, 0], "slide": "BOTTOM"}
+        -> {"board": ..., "reply": {"from": [4, 2], "slide": "TOP"}, "winner": "-"}
+    {"op": "close", "game": 0}
+        -> {"closed": 0}
+
+Coordinates and slides are the ones of Game (from_pos is (X, Y)). Each game is kept
+as a bitboard; the searches of the "online" opponent run in a process pool, so the
+event loop never blocks. Errors are answered with {"error": "..."}; an unexpected one (e.g. a
+broken process pool) also ends the connection. The games of a connection end with it, and
+a client asks for at most --max-rollouts rollouts per server move.
+With --base-model every search process memory-maps the frozen model once, and each
+search starts from a fresh overlay on it; without it the searches start from scratch.
+
+    python server.py serve --port 8765 --workers 4 --base-model models/base
+    python server.py load --port 8765 --games 200 --concurrency 50
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+from random import choice
+import time
+from game import State, apply_move, board_winner, game_move, legal_moves, move_list, MOVE_IDS, SLIDES
+from MCTS import MCTS
+from playout import HeuristicPlayout
+from tables import BaseTable
+
+
+_TREE = None  # search tree of each worker process, shared by the games it serves
+_BASE = None  # frozen model of each worker process, loaded once by _init_worker
+MAX_TREE = 200_000
+MAX_ROLLOUTS = 5_000  # per server move: one request must not hold a search process for long
+
+
+def _init_worker(base_path):
+    global _BASE
+    if base_path is not None:
+        _BASE = BaseTable.load(base_path)
+
+
+def search_move(board, player, rollouts):
+    '''Runs in a worker process: MCTS from `board` with `player` to move, returns a move id'''
+    global _TREE
+    if _BASE is not None:
+        q, n = _BASE.layered()  # the trained statistics, the rollouts of this search in the overlay
+        tree = MCTS(q=q, n=n, widening=2, playout=HeuristicPlayout())
+    else:
+        if _TREE is None or len(_TREE.N) > MAX_TREE:
+            _TREE = MCTS(q=defaultdict(float), n=defaultdict(int), widening=2, playout=HeuristicPlayout())
+        tree = _TREE
+    node = State(board)
+    for _ in range(rollouts):
+        tree.do_rollout(node, player)
+    child = tree.choose(node, opponent="X" if player == "O" else "O", verbose=False)
+    return child.move_id()
+
+
+def move_id(from_pos, slide):
+    "Move id of a Game move, None if there is no such move"
+    x, y = from_pos
+    directions = [d for d, s in SLIDES.items() if s.name == slide]
+    if not directions:
+        return None
+    return MOVE_IDS.get((5*y + x, directions[0]))
+
+
+class Match:
+    "State of one game: the bitboard, who is who, and who moves"
+
+    def __init__(self, client, opponent, rollouts):
+        self.board = 0
+        self.client = client
+        self.server = "X" if client == "O" else "O"
+        self.to_move = "O"
+        self.opponent = opponent
+        self.rollouts = rollouts
+        self.lock = asyncio.Lock()  # one request at a time per game, even from several connections
+
+    def play(self, move):
+        self.board = apply_move(self.board, move, self.to_move)
+        self.to_move = "X" if self.to_move == "O" else "O"
+        return board_winner(self.board)
+
+
+class MatchServer:
+    def __init__(self, workers=None, rollouts=50, base_model=None, max_rollouts=MAX_ROLLOUTS):
+        ### spawned, not forked: a forked worker would keep the sockets of the open connections,
+        ### and a connection closed by the server would never end for its client
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(base_model,))
+        self.rollouts = rollouts
+        self.max_rollouts = max_rollouts
+        self.matches = dict()
+        self.next_id = 0
+
+    async def handle(self, reader, writer):
+        "Serves one connection, answering its requests in order"
+        games = set()  # ids of the games started on this connection, dropped when it ends
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.dispatch(json.loads(line), games)
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                except Exception as e:
+                    ### e.g. a broken process pool: answer, then end the connection
+                    writer.write(json.dumps({"error": f"{type(e).__name__}: {e}"}).encode() + b"\n")
+                    await writer.drain()
+                    break
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass  # the client went away
+        finally:
+            for game in games:
+                self.matches.pop(game, None)
+            writer.close()
+
+    async def dispatch(self, request, games):
+        op = request["op"]
+        if op == "new":
+            client = "O" if request.get("first", "client") == "client" else "X"
+            opponent = request.get("opponent", "online")
+            if opponent not in ("online", "random"):
+                raise ValueError(f"unknown opponent {opponent}")
+            rollouts = int(request.get("rollouts", self.rollouts))
+            if not 0 <= rollouts <= self.max_rollouts:
+                raise ValueError(f"rollouts must be between 0 and {self.max_rollouts}")
+            match = Match(client, opponent, rollouts)
+            game = self.next_id
+            self.next_id += 1
+            self.matches[game] = match
+            games.add(game)
+            response = {"game": game, "you": client}
+            winner = "-"
+            async with match.lock:
+                if match.server == "O":
+                    response["reply"], winner = await self.server_move(match)
+                response.update(board=match.board, winner=winner)
+            return response
+        elif op == "move":
+            game = request["game"]
+            match = self.matches[game]
+            async with match.lock:
+                if self.matches.get(game) is not match:
+                    raise ValueError("the game is over")
+                if match.to_move != match.client:
+                    raise ValueError("not your turn")
+                move = move_id(request["from"], request["slide"])
+                if move is None or not (legal_moves(match.board, match.client) >> move) & 1:
+                    raise ValueError("illegal move")
+                response = {}
+                winner = match.play(move)
+                if winner == "-":
+                    response["reply"], winner = await self.server_move(match)
+                if winner != "-":
+                    del self.matches[game]
+                response.update(board=match.board, winner=winner)
+            return response
+        elif op == "close":
+            self.matches.pop(request["game"], None)
+            games.discard(request["game"])
+            return {"closed": request["game"]}
+        raise ValueError(f"unknown op {op}")
+
+    async def server_move(self, match):
+        if match.opponent == "random":
+            move = choice(move_list(legal_moves(match.board, match.server)))
+        else:
+            loop = asyncio.get_running_loop()
+            move = await loop.run_in_executor(self.pool, search_move, match.board, match.server, match.rollouts)
+        winner = match.play(move)
+        from_pos, slide = game_move(move)
+        return {"from": list(from_pos), "slide": slide.name}, winner
+
+
+async def serve(host="127.0.0.1", port=8765, unix=None, workers=None, rollouts=50, base_model=None,
+                max_rollouts=MAX_ROLLOUTS):
+    server = MatchServer(workers, rollouts, base_model, max_rollouts)
+    if unix is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print(f"Serving Quixo matches on {unix or f'{host}:{port}'}")
+    async with listener:
+        await listener.serve_forever()
+
+
+### LOAD TEST: random clients playing against the server
+
+async def _open(host, port, unix):
+    if unix is not None:
+        return await asyncio.open_unix_connection(unix)
+    return await asyncio.open_connection(host, port)
+
+
+async def _client_game(host, port, unix, opponent, rollouts, max_moves, latencies):
+    reader, writer = await _open(host, port, unix)
+
+    async def request(message):
+        start = time.perf_counter()
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    response = await request({"op": "new", "first": choice(["client", "server"]),
+                              "opponent": opponent, "rollouts": rollouts})
+    game, me = response["game"], response["you"]
+    moves = 0
+    while response["winner"] == "-" and moves < max_moves:
+        from_pos, slide = game_move(choice(move_list(legal_moves(response["board"], me))))
+        response = await request({"op": "move", "game": game, "from": list(from_pos), "slide": slide.name})
+        moves += 1
+    if response["winner"] == "-":
+        await request({"op": "close", "game": game})
+    writer.close()
+    return moves
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def load_test(host="127.0.0.1", port=8765, unix=None, games=100, concurrency=20,
+                    opponent="online", rollouts=20, max_moves=100):
+    '''Plays `games` games (at most `concurrency` at a time) with random moves,
+        reports throughput and latency percentiles of the requests'''
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            return await _client_game(host, port, unix, opponent, rollouts, max_moves, latencies)
+
+    start = time.perf_counter()
+    moves = await asyncio.gather(*(limited() for _ in range(games)))
+    elapsed = time.perf_counter() - start
+    print(f"{games} games, {sum(moves)} client moves in {elapsed:.2f}s: "
+          f"{len(latencies) / elapsed:.1f} requests/s")
+    for p in (50, 90, 99):
+        print(f"  p{p} latency: {1000 * percentile(latencies, p):.1f} ms")
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quixo match server")
+    parser.add_argument("mode", choices=["serve", "load"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="unix socket path, instead of TCP")
+    parser.add_argument("--workers", type=int, default=None, help="search processes (serve)")
+    parser.add_argument("--rollouts", type=int, default=50, help="rollouts per server move")
+    parser.add_argument("--base-model", default=None, help="frozen model the searches start from (serve)")
+    parser.add_argument("--max-rollouts", type=int, default=MAX_ROLLOUTS, help="most rollouts a client may ask for (serve)")
+    parser.add_argument("--games", type=int, default=100, help="games to play (load)")
+    parser.add_argument("--concurrency", type=int, default=20, help="simultaneous games (load)")
+    parser.add_argument("--opponent", default="online", choices=["online", "random"])
+    args = parser.parse_args()
+    if args.mode == "serve":
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.rollouts, args.base_model,
+                          args.max_rollouts))
+    else:
+        asyncio.run(load_test(args.host, args.port, args.unix, args.games, args.concurrency,
+                              args.opponent, args.rollouts))
@@ -0,0 +1,149 @@
+"""
+Exact endgame solver for near-terminal Quixo positions.
+
+A depth-limited negamax on bitboards, with its own transposition table keyed by
+(canonical board, player to move). Values are for the player to move: WIN, DRAW, LOSS,
+or None when the position is not decided within the search depth. With only three values,
+alpha-beta pruning reduces to cutting a node as soon as one winning move is found.
+
+MCTS uses it (MCTS-Solver style) to mark proven positions as solved, so they are never
+rolled out again.
+"""
+import time
+from game import State, move_boards, board_winner, line_threats, canonical_board
+
+
+WIN, DRAW, LOSS = 1, 0, -1
+
+
+class _Timeout(Exception):
+    pass
+
+
+class EndgameSolver:
+    '''
+    depth: maximum number of plies searched
+    time_budget: seconds per `solve` call (None for no limit), the search deepens iteratively
+    max_table: the transposition table is cleared when it grows past this many entries
+    tablebase: precomputed results (see tablebase.py) looked up before searching a position
+    '''
+
+    def __init__(self, depth=2, time_budget=None, max_table=1_000_000, tablebase=None):
+        self.depth = depth
+        self.tablebase = tablebase
+        self.time_budget = time_budget
+        self.max_table = max_table
+        self.table = dict()  # (canonical board, player) -> (value, searched depth)
+        self.deadline = None
+        self.nodes = 0
+
+    @staticmethod
+    def reward_for(player):
+        "Reward (on the State.reward scale) of a position won by `player`"
+        return 3 if player == "O" else -1
+
+    def applicable(self, board):
+        "Within 2 plies a result can only be forced if someone already has 4 in a line, deeper searches always run"
+        if self.depth > 2:
+            return True
+        o_threats, x_threats = line_threats(board)
+        return o_threats > 0 or x_threats > 0
+
+    def solve(self, node, player):
+        '''Returns (reward, best child State) for `node` with `player` to move,
+            (None, None) if the position is not proven within the budget'''
+        if not self.applicable(node.board):
+            return None, None
+        value, move = self.solve_board(node.board, player)
+        if value is None:
+            return None, None
+        other = "X" if player == "O" else "O"
+        if value == WIN:
+            reward = self.reward_for(player)
+        elif value == LOSS:
+            reward = self.reward_for(other)
+        else:
+            reward = 1
+        board, row, col, direction = move
+        return reward, State(board, row=row, col=col, direction=direction, parent=node.board)
+
+    def solve_board(self, board, player):
+        "(value for the player to move, best move) of a bitboard, (None, None) if not proven"
+        if len(self.table) > self.max_table:
+            self.table.clear()
+        self.deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        result = (None, None)
+        try:
+            for depth in range(1, self.depth + 1):
+                result = self._root(board, player, depth)
+                if result[0] is not None:
+                    break
+        except _Timeout:
+            pass
+        return result
+
+    def _root(self, board, player, depth):
+        best = None
+        best_value = None
+        unknown = False
+        for move in move_boards(board, player):
+            value = self._move_value(move[0], player, depth)
+            if value == WIN:
+                return WIN, move
+            if value is None:
+                unknown = True
+            elif best_value is None or value > best_value:
+                best, best_value = move, value
+        if unknown:
+            return None, None
+        return best_value, best
+
+    def _move_value(self, child, player, depth):
+        "Value for `player` of the move leading to `child`, None if unknown at this depth"
+        winner = board_winner(child)
+        if winner == player:
+            return WIN
+        elif winner == "D":
+            return DRAW
+        elif winner != "-":
+            return LOSS
+        other = "X" if player == "O" else "O"
+        if self.tablebase is not None:
+            value = self.tablebase.lookup(child, other)
+            if value is not None:
+                return -value
+        if depth <= 1:
+            return None
+        value = self._negamax(child, other, depth - 1)
+        return None if value is None else -value
+
+    def _negamax(self, board, player, depth):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise _Timeout()
+        key = (canonical_board(board), player)
+        entry = self.table.get(key)
+        if entry is not None and (entry[0] is not None or entry[1] >= depth):
+            return entry[0]
+        self.nodes += 1
+
+        moves = move_boards(board, player)
+        ### immediate wins first, they cut the whole node
+        for child, _, _, _ in moves:
+            if board_winner(child) == player:
+                self.table[key] = (WIN, depth)
+                return WIN
+        best = None
+        unknown = False
+        for child, _, _, _ in moves:
+            value = self._move_value(child, player, depth)
+            if value == WIN:
+                best = WIN
+                unknown = False
+                break
+            if value is None:
+                unknown = True
+            elif best is None or value > best:
+                best = value
+        value = None if unknown else best
+        self.table[key] = (value, depth)
+        return value
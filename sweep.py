@@ -0,0 +1,150 @@
+"""
+Hyperparameter sweep of the MCTS settings (exploration_weight, epsilon, opponent_level).
+
+Every configuration of a grid, or of a random sample, is trained from the empty board for a
+short run and then plays headless bitboard games against fixed opponents ("random" moves and
+the greedy "heuristic" playout policy), half of them as O and half as X. The configurations
+are run in a process pool with successive halving: after each round only the best 1/eta of
+them go on, and are trained again with eta times more rollouts, so the CPU is spent on the
+promising ones. The result is a table ranked by strength (points per game: 1 per win,
+0.5 per draw) with the training speed of each configuration.
+
+    python sweep.py --mode grid --rollouts 100 --rounds 3 --eta 3 --games 20
+    python sweep.py --mode random --samples 30 --opponents random heuristic
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import math
+import random
+import time
+from game import State, apply_move, board_winner, legal_moves, move_list
+from MCTS import MCTS
+from playout import HeuristicPlayout
+
+
+GRID = {
+    "exploration_weight": [0.7, math.sqrt(2), 2.0],
+    "epsilon": [0.2, 0.4, 0.7],
+    "opponent_level": [0.0, 0.1, 0.3],
+}
+
+
+def grid_configs(grid=GRID):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in product(*(grid[name] for name in names))]
+
+
+def random_configs(samples, rng):
+    "Log-uniform exploration weight, uniform epsilon and opponent level"
+    return [{"exploration_weight": math.exp(rng.uniform(math.log(0.3), math.log(3.0))),
+             "epsilon": rng.uniform(0.0, 1.0),
+             "opponent_level": rng.uniform(0.0, 0.5)} for _ in range(samples)]
+
+
+### FIXED OPPONENTS, on bitboards
+
+def random_opponent(board, player):
+    return apply_move(board, random.choice(move_list(legal_moves(board, player))), player)
+
+
+_GREEDY = HeuristicPlayout(epsilon=0.0)
+
+
+def heuristic_opponent(board, player):
+    return _GREEDY.choose(board, player)[0]
+
+
+OPPONENTS = {"random": random_opponent, "heuristic": heuristic_opponent}
+
+
+def play_games(tree, opponent, games, max_moves=100, move_rollouts=0):
+    '''Plays `games` games of the tree against `opponent`, all at once: at every step the
+        boards where the tree is to move are decided with one `choose_many` call.
+        Returns the points of the tree (1 per win, 0.5 per draw or unfinished game)'''
+    sides = ["O" if i % 2 == 0 else "X" for i in range(games)]
+    boards = [0] * games
+    winners = ["-"] * games
+    turn = "O"
+    for _ in range(max_moves):
+        active = [i for i in range(games) if winners[i] == "-"]
+        if not active:
+            break
+        mine = [i for i in active if sides[i] == turn]
+        if mine:
+            for i in mine:
+                for _ in range(move_rollouts):
+                    tree.do_rollout(State(boards[i]), turn)
+            other = "X" if turn == "O" else "O"
+            for i, child in zip(mine, tree.choose_many([boards[i] for i in mine], opponent=other)):
+                boards[i] = child.board
+        for i in active:
+            if sides[i] != turn:
+                boards[i] = opponent(boards[i], turn)
+            winners[i] = board_winner(boards[i])
+        turn = "X" if turn == "O" else "O"
+    return sum(1.0 if w == s else 0.0 if w in ("O", "X") else 0.5 for w, s in zip(winners, sides))
+
+
+def evaluate_config(config, rollouts, games, opponents, seed, move_rollouts=0):
+    '''Runs in a worker process: trains `config` for `rollouts` rollouts and plays `games`
+        games against each opponent. Returns (strength, rollouts per second)'''
+    random.seed(seed)
+    tree = MCTS(q=defaultdict(float), n=defaultdict(int), **config)
+    start = time.perf_counter()
+    for _ in range(rollouts):
+        tree.do_rollout(State(0))
+    speed = rollouts / (time.perf_counter() - start)
+    points = sum(play_games(tree, OPPONENTS[name], games, move_rollouts=move_rollouts) for name in opponents)
+    return points / (games * len(opponents)), speed
+
+
+def successive_halving(configs, rollouts=100, rounds=3, eta=3, games=20, opponents=("random", "heuristic"),
+                       workers=None, seed=0, move_rollouts=0):
+    '''Evaluates the configurations, keeping the best 1/eta of them after each round and
+        multiplying their rollouts by eta. Returns one result dict per configuration, ranked'''
+    results = [{"config": config, "round": 0, "rollouts": 0, "strength": None, "speed": None} for config in configs]
+    alive = list(range(len(configs)))
+    with ProcessPoolExecutor(workers) as pool:
+        for r in range(rounds):
+            budget = rollouts * eta**r
+            futures = {i: pool.submit(evaluate_config, configs[i], budget, games, opponents,
+                                      hash((seed, i, r)), move_rollouts) for i in alive}
+            for i, future in futures.items():
+                strength, speed = future.result()
+                results[i].update(round=r + 1, rollouts=budget, strength=strength, speed=speed)
+            alive.sort(key=lambda i: results[i]["strength"], reverse=True)
+            print(f"round {r + 1}: {len(alive)} configs at {budget} rollouts, "
+                  f"best strength {results[alive[0]]['strength']:.3f}")
+            alive = alive[:max(1, len(alive) // eta)]  # a lone survivor still gets the larger budgets
+    return sorted(results, key=lambda res: (res["round"], res["strength"]), reverse=True)
+
+
+def print_table(results):
+    print(f"{'rank':>4} {'expl.':>6} {'eps.':>6} {'opp.':>6} {'round':>5} {'rollouts':>8} {'strength':>8} {'roll/s':>8}")
+    for rank, res in enumerate(results, 1):
+        config = res["config"]
+        print(f"{rank:>4} {config['exploration_weight']:>6.3f} {config['epsilon']:>6.3f} "
+              f"{config['opponent_level']:>6.3f} {res['round']:>5} {res['rollouts']:>8} "
+              f"{res['strength']:>8.3f} {res['speed']:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Successive halving sweep of the MCTS hyperparameters")
+    parser.add_argument("--mode", choices=["grid", "random"], default="grid")
+    parser.add_argument("--samples", type=int, default=27, help="configurations (random mode)")
+    parser.add_argument("--rollouts", type=int, default=100, help="training rollouts of the first round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--eta", type=int, default=3, help="1/eta of the configurations survive each round")
+    parser.add_argument("--games", type=int, default=20, help="games against each opponent")
+    parser.add_argument("--move-rollouts", type=int, default=0, help="extra rollouts before each move")
+    parser.add_argument("--opponents", nargs="+", default=["random", "heuristic"], choices=sorted(OPPONENTS))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    configs = grid_configs() if args.mode == "grid" else random_configs(args.samples, rng)
+    results = successive_halving(configs, args.rollouts, args.rounds, args.eta, args.games, args.opponents,
+                                 args.workers, args.seed, args.move_rollouts)
+    print_table(results)
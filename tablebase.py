@@ -0,0 +1,147 @@
+"""
+Precomputed results of Quixo positions, stored in a compact memory-mapped file.
+
+Positions are normalized with the player to move as O (see State.create_position), reduced
+to their canonical symmetric image and indexed densely: positions with k pieces come after
+all the positions with fewer pieces, and among them the index is the combinatorial rank of
+the set of occupied cells times 2^k plus the colors of the pieces.
+Each index stores 2 bits: UNKNOWN, WIN, LOSS or DRAW for the player to move.
+
+The index is dense over all the positions, not over the canonical ones: only canonical
+boards are stored and looked up, so about 7/8 of the slots stay UNKNOWN and a file is
+roughly 8 times larger than a canonical ranking would need (480 KB for 0-5 pieces).
+The trade is deliberate: the rank is a cheap closed formula, while ranking within the
+symmetry classes would need per-piece-count tables of the canonical boards.
+
+A table only needs to cover a range of piece counts, e.g.
+
+    python tablebase.py quixo.qtb --min-pieces 0 --max-pieces 5 --depth 2
+
+The results come from the endgame solver, so positions it cannot prove stay UNKNOWN.
+"""
+import argparse
+from itertools import combinations
+from math import comb
+import numpy
+from game import board_winner, canonical_board, swap_board
+from solver import EndgameSolver, WIN, DRAW, LOSS
+
+
+MAGIC = b"QXTB"
+HEADER_SIZE = 16
+UNKNOWN_CODE, WIN_CODE, LOSS_CODE, DRAW_CODE = 0, 1, 2, 3
+CODES = {WIN: WIN_CODE, LOSS: LOSS_CODE, DRAW: DRAW_CODE}
+VALUES = {WIN_CODE: WIN, LOSS_CODE: LOSS, DRAW_CODE: DRAW}
+
+### number of positions with fewer than k pieces
+OFFSETS = [0]
+for k in range(26):
+    OFFSETS.append(OFFSETS[-1] + comb(25, k) * 2**k)
+
+
+def position_index(board):
+    '''Dense index of an (O to move) board: offset of its piece count, then rank of the
+        occupied cells (colex order) times 2^k, plus one bit per piece set if it is an O.
+        Non-canonical boards have an index too, their slots are simply never filled'''
+    o = board & 33554431
+    occupied = o | ((board >> 32) & 33554431)
+    rank = 0
+    colors = 0
+    i = 0
+    while occupied:
+        low = occupied & -occupied
+        cell = low.bit_length() - 1
+        rank += comb(cell, i + 1)
+        if o & low:
+            colors |= 1 << i
+        occupied ^= low
+        i += 1
+    return OFFSETS[i] + (rank << i) + colors
+
+
+def positions(k):
+    "All the (O to move) boards with k pieces"
+    for cells in combinations(range(25), k):
+        for colors in range(2**k):
+            board = 0
+            for i, cell in enumerate(cells):
+                board |= 1 << (cell if (colors >> i) & 1 else cell + 32)
+            yield board
+
+
+class Tablebase:
+    "Read-only view on a table file, memory-mapped"
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            header = file.read(HEADER_SIZE)
+        if header[:4] != MAGIC:
+            raise ValueError(f"{path} is not a Quixo table")
+        self.min_pieces = header[4]
+        self.max_pieces = header[5]
+        self.start = OFFSETS[self.min_pieces]
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode="r", offset=HEADER_SIZE)
+
+    def lookup(self, board, player):
+        "WIN, LOSS or DRAW for `player` to move, None if unknown or not covered by the table"
+        if player == "X":
+            board = swap_board(board)
+        pieces = (board & 33554431).bit_count() + (board >> 32).bit_count()
+        if not self.min_pieces <= pieces <= self.max_pieces:
+            return None
+        index = position_index(canonical_board(board)) - self.start
+        code = (int(self.data[index >> 2]) >> ((index & 3) * 2)) & 3
+        return VALUES.get(code)
+
+    def reward(self, board, player):
+        "Result on the State.reward scale (3 = O wins, 1 = draw, -1 = X wins), None if unknown"
+        value = self.lookup(board, player)
+        if value is None:
+            return None
+        if value == DRAW:
+            return 1
+        winner = player if value == WIN else ("X" if player == "O" else "O")
+        return 3 if winner == "O" else -1
+
+
+def build(path, min_pieces, max_pieces, depth=2, time_budget=None):
+    '''Solves every canonical position with min_pieces..max_pieces pieces and writes the table'''
+    solver = EndgameSolver(depth=depth, time_budget=time_budget)
+    start = OFFSETS[min_pieces]
+    data = bytearray((OFFSETS[max_pieces + 1] - start + 3) // 4)
+    known = 0
+    for k in range(min_pieces, max_pieces + 1):
+        for board in positions(k):
+            if board != canonical_board(board):
+                continue
+            winner = board_winner(board)
+            if winner == "O":
+                code = WIN_CODE
+            elif winner == "X":
+                code = LOSS_CODE
+            elif winner == "D":
+                code = DRAW_CODE
+            elif solver.applicable(board):
+                code = CODES.get(solver.solve_board(board, "O")[0], UNKNOWN_CODE)
+            else:
+                continue
+            if code != UNKNOWN_CODE:
+                index = position_index(board) - start
+                data[index >> 2] |= code << ((index & 3) * 2)
+                known += 1
+        print(f"{k} pieces done, {known} positions known")
+    with open(path, "wb") as file:
+        file.write(MAGIC + bytes([min_pieces, max_pieces]) + bytes(HEADER_SIZE - 6))
+        file.write(data)
+    print(f"Successfully saved table ({len(data)} bytes) to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a table of solved Quixo positions")
+    parser.add_argument("path")
+    parser.add_argument("--min-pieces", type=int, default=0)
+    parser.add_argument("--max-pieces", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--time-budget", type=float, default=None)
+    args = parser.parse_args()
+    build(args.path, args.min_pieces, args.max_pieces, args.depth, args.time_budget)
@@ -0,0 +1,251 @@
+"""
+Frozen Q/N tables for the Monte Carlo players.
+
+A trained model is frozen into a `BaseTable`: three numpy arrays (canonical board keys,
+Q and N) sorted by key, saved as .npy files and memory-mapped when loaded, so every game
+process serving the same model shares a single copy of it through the page cache.
+Each player wraps the base into a pair of `LayeredTable`s, which keep the rollouts done
+during its own game in a small copy-on-write overlay and fall through to the base otherwise.
+
+Checkpoints of separate trainings are merged into one base model with `merge_models`:
+
+    python tables.py models/merged run1/last_q run2/last_q models/old_base --min-visits 5
+
+Each input (a q pickle, whose n pickle is found by the same name with q -> n, or a base model
+folder) is loaded alone and written to disk as a sorted run, then the runs are merged
+block by block, so only one input pickle is ever in memory. The checkpoints of one training
+are cumulative: merge the last one of each run, not all of them.
+"""
+import argparse
+from collections import defaultdict
+import heapq
+from itertools import groupby
+from operator import itemgetter
+import os
+import tempfile
+import numpy
+from game import load_table
+
+
+def table_key(node):
+    "Integer key of a node in the tables: boards are keyed up to symmetry"
+    if hasattr(node, "canonical_key"):
+        return node.canonical_key()
+    return int(node)
+
+
+class BaseTable:
+    "Read-only Q/N statistics of a trained model, sorted by canonical key"
+
+    FILES = ("keys.npy", "q.npy", "n.npy")
+
+    def __init__(self, keys, q, n):
+        self.keys = keys
+        self.q = q
+        self.n = n
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        "Loads a table saved with `save`, memory-mapping it unless `mmap` is False"
+        mode = "r" if mmap else None
+        keys, q, n = (numpy.load(os.path.join(path, name), mmap_mode=mode) for name in cls.FILES)
+        return cls(keys, q, n)
+
+    @classmethod
+    def from_model(cls, q, n):
+        "Builds the table from Q/N dictionaries, summing the entries of equivalent boards"
+        totals = defaultdict(lambda: [0.0, 0])
+        for node, visits in n.items():
+            total = totals[table_key(node)]
+            total[0] += q.get(node, 0.0)
+            total[1] += visits
+        keys = sorted(totals)
+        return cls(numpy.array(keys, dtype=numpy.int64),
+                   numpy.array([totals[k][0] for k in keys], dtype=numpy.float64),
+                   numpy.array([totals[k][1] for k in keys], dtype=numpy.int64))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, array in zip(self.FILES, (self.keys, self.q, self.n)):
+            numpy.save(os.path.join(path, name), array)
+        print(f"Successfully saved base model ({len(self)} positions) to {path}")
+
+    def find(self, key):
+        "Index of `key` in the table, -1 if the position was never visited in training"
+        i = int(numpy.searchsorted(self.keys, numpy.int64(key)))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def find_many(self, keys):
+        "Indexes of many keys at once (one vectorized search), -1 for the missing ones"
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        if not len(self.keys):
+            return numpy.full(len(keys), -1)
+        indexes = numpy.minimum(numpy.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return numpy.where(self.keys[indexes] == keys, indexes, -1)
+
+    def layered(self):
+        "Returns a fresh (Q, N) pair of writable views on the table, e.g. for one game"
+        return LayeredTable(self, self.q, 0.0), LayeredTable(self, self.n, 0)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class LayeredTable:
+    '''
+    Dictionary-like view on one column of a `BaseTable`.
+    Writes go to a private overlay, reads look up the overlay first and then the base,
+    so the (shared) base is never modified.
+    '''
+
+    def __init__(self, base, values, default):
+        self.base = base
+        self.values = values
+        self.default = default
+        self.overlay = dict()
+        self.added = 0  # overlay keys that are not in the base
+
+    def __getitem__(self, node):
+        key = table_key(node)
+        if key in self.overlay:
+            return self.overlay[key]
+        i = self.base.find(key)
+        return self.default if i < 0 else self.values[i].item()
+
+    def __setitem__(self, node, value):
+        key = table_key(node)
+        if key not in self.overlay and self.base.find(key) < 0:
+            self.added += 1
+        self.overlay[key] = value
+
+    def __contains__(self, node):
+        key = table_key(node)
+        return key in self.overlay or self.base.find(key) >= 0
+
+    def __len__(self):
+        return len(self.base) + self.added
+
+    def get(self, node, default=None):
+        return self[node] if node in self else default
+
+    def get_many(self, nodes):
+        "Values of many nodes at once, searching the base only once for all the keys not in the overlay"
+        keys = [table_key(node) for node in nodes]
+        values = [self.overlay.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            indexes = self.base.find_many([keys[i] for i in missing])
+            for i, index in zip(missing, indexes):
+                values[i] = self.default if index < 0 else self.values[index].item()
+        return values
+
+    def reset(self):
+        "Drops the overlay, going back to the trained model"
+        self.overlay = dict()
+        self.added = 0
+
+
+### MERGING AND PRUNING CHECKPOINTS
+
+def _checkpoint_paths(path_q):
+    "The n pickle saved along a q pickle (q_3 -> n_3, last_q -> last_n)"
+    folder, name = os.path.split(path_q)
+    if name.startswith("q"):
+        return path_q, os.path.join(folder, "n" + name[1:])
+    if name.endswith("q"):
+        return path_q, os.path.join(folder, name[:-1] + "n")
+    raise ValueError(f"{path_q} is not a q checkpoint")
+
+
+def _sorted_run(path, folder):
+    "A base model (memory-mapped), or a checkpoint written to `folder` as one"
+    if os.path.isdir(path):
+        return BaseTable.load(path)
+    path_q, path_n = _checkpoint_paths(path)
+    with open(path_q, 'rb') as file:
+        q = load_table(file)
+    with open(path_n, 'rb') as file:
+        n = load_table(file)
+    table = BaseTable.from_model(q, n)
+    del q, n
+    for name, array in zip(BaseTable.FILES, (table.keys, table.q, table.n)):
+        numpy.save(os.path.join(folder, name), array)
+    return BaseTable.load(folder)
+
+
+def _entries(table, block):
+    "(key, Q, N) of a table in key order, reading `block` entries at a time"
+    for start in range(0, len(table), block):
+        end = start + block
+        yield from zip(table.keys[start:end].tolist(), table.q[start:end].tolist(), table.n[start:end].tolist())
+
+
+def merge_models(inputs, path, min_visits=1, block=1 << 16, tmp=None):
+    '''
+    Merges q/n checkpoints and base models into one base model saved in `path`, summing Q and N
+    of equivalent boards and dropping the positions visited fewer than `min_visits` times.
+    Returns the number of positions kept.
+    '''
+    os.makedirs(path, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=tmp) as folder:
+        runs = []
+        for i, source in enumerate(inputs):
+            run = os.path.join(folder, f"run_{i}")
+            os.makedirs(run)
+            runs.append(_sorted_run(source, run))
+            print(f"{source}: {len(runs[-1])} positions")
+
+        ### k-way merge into raw files, then copied into the .npy files once the size is known
+        raw = [open(os.path.join(folder, name + ".raw"), 'wb') for name in BaseTable.FILES]
+        dtypes = (numpy.int64, numpy.float64, numpy.int64)
+        buffers = ([], [], [])
+        kept = pruned = 0
+
+        def flush():
+            for file, buffer, dtype in zip(raw, buffers, dtypes):
+                numpy.array(buffer, dtype=dtype).tofile(file)
+                buffer.clear()
+
+        merged = heapq.merge(*(_entries(run, block) for run in runs))
+        for key, entries in groupby(merged, key=itemgetter(0)):
+            q = n = 0
+            for _, entry_q, entry_n in entries:
+                q += entry_q
+                n += entry_n
+            if n < min_visits:
+                pruned += 1
+                continue
+            for buffer, value in zip(buffers, (key, q, n)):
+                buffer.append(value)
+            kept += 1
+            if len(buffers[0]) >= block:
+                flush()
+        flush()
+        for file in raw:
+            file.close()
+
+        for name, dtype in zip(BaseTable.FILES, dtypes):
+            out = numpy.lib.format.open_memmap(os.path.join(path, name), mode="w+", dtype=dtype, shape=(kept,))
+            if kept:
+                source = numpy.memmap(os.path.join(folder, name + ".raw"), dtype=dtype, mode="r")
+                for start in range(0, kept, block):
+                    out[start:start + block] = source[start:start + block]
+                del source
+            out.flush()
+            del out
+        del runs
+    print(f"Successfully merged {len(inputs)} models into {path}: {kept} positions kept, {pruned} pruned")
+    return kept
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge and prune Q/N checkpoints into one base model")
+    parser.add_argument("path", help="folder of the merged base model")
+    parser.add_argument("inputs", nargs="+", help="q checkpoints (q_3, last_q, ...) or base model folders")
+    parser.add_argument("--min-visits", type=int, default=1, help="drop the positions visited fewer times")
+    parser.add_argument("--block", type=int, default=1 << 16, help="entries read or written at a time")
+    parser.add_argument("--tmp", default=None, help="folder for the sorted runs")
+    args = parser.parse_args()
+    merge_models(args.inputs, args.path, args.min_visits, args.block, args.tmp)
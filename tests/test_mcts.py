@@ -0,0 +1,53 @@
+import random
+from collections import defaultdict
+from game import State, apply_move
+from MCTS import MCTS
+from playout import HeuristicPlayout
+
+
+def selected_paths(tree, node, rollouts):
+    "Runs the rollouts, returning the path selected by each of them"
+    paths = []
+    select = tree._select
+
+    def recording_select(*args, **kwargs):
+        path = select(*args, **kwargs)
+        paths.append(path)
+        return path
+
+    tree._select = recording_select
+    for _ in range(rollouts):
+        tree.do_rollout(node)
+    return paths
+
+
+def test_widening_never_selects_past_a_terminal_node():
+    random.seed(0)
+    tree = MCTS(q=defaultdict(float), n=defaultdict(int), widening=2, playout=HeuristicPlayout())
+    paths = selected_paths(tree, State(0b11110), 300)
+    assert all(not node.is_terminal() for path in paths for node in path[:-1])
+    assert any(path[-1].is_terminal() for path in paths)
+
+
+class ListRecorder:
+    "In-memory stand-in for a TrajectoryRecorder"
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, player, boards, moves, reward):
+        self.records.append((player, boards, moves))
+
+
+def test_recorded_trajectories_replay_in_one_frame():
+    random.seed(0)
+    recorder = ListRecorder()
+    tree = MCTS(q=defaultdict(float), n=defaultdict(int), widening=2, playout=HeuristicPlayout(), recorder=recorder)
+    for _ in range(200):
+        tree.do_rollout(State(0))
+    for player, boards, moves in recorder.records:
+        assert len(boards) == len(moves) + 1
+        other = "X" if player == "O" else "O"
+        for board, move, child in zip(boards, moves, boards[1:]):
+            assert child in (apply_move(board, move, player), apply_move(board, move, other))
+            player, other = other, player
@@ -0,0 +1,51 @@
+import random
+from game import State, board_winner, move_children
+from solver import EndgameSolver, WIN, DRAW, LOSS
+
+
+def random_board(rng, fill=0.8):
+    board = 0
+    for i in range(25):
+        if rng.random() < fill:
+            board |= 1 << (24 - i if rng.random() < 0.5 else 56 - i)
+    return board
+
+
+def brute_force(board, player, depth):
+    "Plain negamax over every move: value for the player to move, None if not decided in `depth` plies"
+    other = "X" if player == "O" else "O"
+    values = []
+    for child, _ in move_children(board, player):
+        winner = board_winner(child)
+        if winner == player:
+            return WIN
+        if winner == "D":
+            values.append(DRAW)
+        elif winner != "-":
+            values.append(LOSS)
+        elif depth <= 1:
+            values.append(None)
+        else:
+            value = brute_force(child, other, depth - 1)
+            if value == LOSS:
+                return WIN
+            values.append(None if value is None else -value)
+    if None in values:
+        return None
+    return max(values)
+
+
+def test_solver_matches_brute_force_negamax():
+    rng = random.Random(0)
+    boards = [b for b in (random_board(rng) for _ in range(400)) if board_winner(b) == "-"]
+    for depth, count in ((1, 60), (2, 30), (3, 12)):
+        for board in boards[:count]:
+            for player in ("O", "X"):
+                assert EndgameSolver(depth=depth).solve_board(board, player)[0] == brute_force(board, player, depth)
+
+
+def test_deep_solver_proves_positions_without_threats():
+    board = 0xac110401434aab
+    assert EndgameSolver(depth=3).solve_board(board, "O")[0] == WIN
+    reward, child = EndgameSolver(depth=3).solve(State(board), "O")
+    assert reward == EndgameSolver.reward_for("O") and child is not None
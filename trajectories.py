@@ -0,0 +1,172 @@
+"""
+Streaming export of the rollouts, for offline analysis and learning.
+
+With `MCTS(recorder=TrajectoryRecorder(path))` every rollout is written to disk: the player
+to move at the root, the boards from the root to the end of the simulation, the ids of the
+moves between them (NO_MOVE when unknown) and the final reward. The rollout loop only appends
+to a list; full chunks are packed and written by a background thread.
+
+The file is append-only: a header, then chunks of records, each chunk prefixed by its number
+of records and its size. Every chunk also gets an entry (offset, records) in `path + ".idx"`,
+so a reader can count the records or start at any chunk without scanning the file.
+A record is
+    plies (uint32), root player (uint8, 0 = O), reward (float32),
+    plies + 1 boards (uint64), plies move ids (uint8)
+All the boards and moves of a record are in the frame of the root board, so a trajectory
+replays: boards[i + 1] == apply_move(boards[i], moves[i], player), the players alternating
+from the root player. The only exception is in the tree part of a rollout, as the tree keys
+its nodes by board alone: a node first expanded with the other player to move keeps the
+children of that player, and the move of that ply is then the other player's.
+
+    python trajectories.py stats rollouts.qtr
+"""
+import argparse
+from collections import Counter, namedtuple
+import os
+import queue
+import struct
+import threading
+
+
+MAGIC = b"QXTR\x01\x00\x00\x00"
+CHUNK_HEADER = struct.Struct("<II")  # records, bytes
+RECORD_HEADER = struct.Struct("<IBf")  # plies, root player, reward
+INDEX_ENTRY = struct.Struct("<QI")  # offset of the chunk, records
+NO_MOVE = 255
+PLAYERS = ("O", "X")
+OUTCOMES = {3: "O wins", 1: "draw", -1: "X wins"}  # the terminal rewards of State.reward
+
+Trajectory = namedtuple("Trajectory", ["player", "reward", "boards", "moves"])
+
+
+def pack_records(records):
+    "One chunk payload from (player, boards, moves, reward) tuples"
+    payload = bytearray()
+    for player, boards, moves, reward in records:
+        plies = len(moves)
+        payload += RECORD_HEADER.pack(plies, PLAYERS.index(player), reward)
+        payload += struct.pack(f"<{plies + 1}Q", *boards)
+        payload += bytes(NO_MOVE if move is None else move for move in moves)
+    return payload
+
+
+def unpack_records(payload, count):
+    offset = 0
+    for _ in range(count):
+        plies, player, reward = RECORD_HEADER.unpack_from(payload, offset)
+        offset += RECORD_HEADER.size
+        boards = struct.unpack_from(f"<{plies + 1}Q", payload, offset)
+        offset += 8 * (plies + 1)
+        moves = tuple(payload[offset:offset + plies])
+        offset += plies
+        yield Trajectory(PLAYERS[player], reward, boards, moves)
+
+
+class TrajectoryRecorder:
+    '''
+    Buffered writer of trajectories: `chunk_records` rollouts are packed into one chunk,
+    chunks are written by a background thread. `close` (or leaving a with block) writes
+    what is left; until then the file holds all the complete chunks.
+    '''
+
+    def __init__(self, path, chunk_records=4096, max_pending=16):
+        self.path = path
+        self.chunk_records = chunk_records
+        self.buffer = []
+        self.records = 0
+        self.queue = queue.Queue(max_pending)  # bounded: a slow disk slows the rollouts instead of eating memory
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        self.index = open(path + ".idx", "ab")
+        if new:
+            self.file.write(MAGIC)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def record(self, player, boards, moves, reward):
+        "Adds one rollout: the boards from the root, the moves between them and the reward"
+        self.buffer.append((player, boards, moves, reward))
+        if len(self.buffer) >= self.chunk_records:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.records += len(self.buffer)
+            self.buffer = []
+
+    def _write(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                return
+            payload = pack_records(records)
+            offset = self.file.tell()
+            self.file.write(CHUNK_HEADER.pack(len(records), len(payload)))
+            self.file.write(payload)
+            self.file.flush()
+            self.index.write(INDEX_ENTRY.pack(offset, len(records)))
+            self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.index.close()
+        print(f"Successfully recorded {self.records} trajectories to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_index(path):
+    "(offset, records) of every chunk of a trajectory file"
+    with open(path + ".idx", "rb") as file:
+        data = file.read()
+    return [INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size)]
+
+
+def count_trajectories(path):
+    return sum(records for _, records in read_index(path))
+
+
+def read_trajectories(path, first_chunk=0):
+    "Yields the trajectories of a file one chunk at a time, starting at chunk `first_chunk`"
+    index = read_index(path)
+    if first_chunk >= len(index):
+        return
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a trajectory file")
+        file.seek(index[first_chunk][0])
+        for _ in range(len(index) - first_chunk):
+            records, size = CHUNK_HEADER.unpack(file.read(CHUNK_HEADER.size))
+            yield from unpack_records(file.read(size), records)
+
+
+def stats(path):
+    "Number of trajectories, their lengths and rewards"
+    count = 0
+    total_plies = 0
+    longest = 0
+    rewards = Counter()
+    for trajectory in read_trajectories(path):
+        count += 1
+        total_plies += len(trajectory.moves)
+        longest = max(longest, len(trajectory.moves))
+        rewards[OUTCOMES.get(trajectory.reward, "cut (evaluated)")] += 1
+    print(f"{count} trajectories, {total_plies / max(count, 1):.1f} plies on average, longest {longest}")
+    for outcome, n in rewards.most_common():
+        print(f"  {outcome}: {n} ({100 * n / count:.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect a trajectory file")
+    parser.add_argument("mode", choices=["stats"])
+    parser.add_argument("path")
+    args = parser.parse_args()
+    stats(args.path)